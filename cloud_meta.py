@@ -1,5 +1,41 @@
 #!/usr/bin/env python
+""" cloud-meta is called in tight shell loops (service start, fabfile tasks): only the stdlib
+    modules needed by every command are imported here. Heavier dependencies (psycopg2, sqlite3,
+    SocketServer, ...) are imported by the functions using them, and the log file is only opened
+    on the first log record. Use `--profile-startup` to check the import time breakdown.
+"""
+import sys
+import time
+
+_STARTUP_TIME = time.time()
+_STARTUP_IMPORTS = []  # list of [depth, module name, duration]
+STARTUP_BUDGET_MS = 50  # expected time to answer a read command from the snapshot, without connection
+
+
+def _profile_imports():
+    """ Wrap the builtin __import__ to record the time spent in each first import of a module """
+    import __builtin__
+    real_import = __builtin__.__import__
+    stack = []
+
+    def _import(name, *args, **kwargs):
+        if name in sys.modules:
+            return real_import(name, *args, **kwargs)
+        entry = [len(stack), name, 0.0]
+        _STARTUP_IMPORTS.append(entry)
+        stack.append(name)
+        start = time.time()
+        try:
+            return real_import(name, *args, **kwargs)
+        finally:
+            entry[2] = time.time() - start
+            stack.pop()
+    __builtin__.__import__ = _import
 
+if '--profile-startup' in sys.argv:
+    _profile_imports()
+
+from collections import OrderedDict
 import contextlib
 import datetime
 import json
@@ -7,18 +43,30 @@ import logging
 from functools import wraps
 import os
 import re
-import sys
-
-from psycopg2.pool import ThreadedConnectionPool
-from psycopg2.extras import NamedTupleCursor
+import threading
 
 HERE = os.path.dirname(os.path.realpath(__file__))
 
 ODOO_LONGPOLLINGPORT_OFFSET = 3
+# ports allocated when the port computed from the version is not available (extra instances,
+# sidecars, taken or non numeric versions): out of the computed ones, to never steal them
+ODOO_PORT_RANGE = (20000, 29999)
+ODOO_PORT_HTTP = 'http'
+ODOO_PORT_LONGPOLLING = 'longpolling'
+ODOO_UNIX_USER = 'odoo'
+
+META_SOCKET = '/var/run/cloud-meta.sock'
+META_SOCKET_TIMEOUT = 10
+
+SNAPSHOT_PATH = os.path.join(HERE, 'log', 'meta-snapshot.db')
+SNAPSHOT_CHECK_INTERVAL = 30
+SNAPSHOT_MAX_AGE = 300  # seconds a snapshot is trusted without checking the generation of the meta database
+_snapshot_lock = threading.Lock()  # the daemon keeper and request threads can refresh at once
+_snapshot_outdated = threading.Event()  # set by the daemon writes to wake up the snapshot keeper
 
 _logger = logging.getLogger(__name__)
 _log_fmt = logging.Formatter('[%(asctime)s] %(levelname)s pid=%(process)d db=meta %(message)s')
-_log_hndl = logging.FileHandler(os.path.expanduser('%s/log/meta.log' % (HERE,)))
+_log_hndl = logging.FileHandler(os.path.expanduser('%s/log/meta.log' % (HERE,)), delay=True)
 _log_hndl.setFormatter(_log_fmt)
 _logger.addHandler(_log_hndl)
 _logger.setLevel(logging.INFO)
@@ -78,6 +126,241 @@ def domain2database(domain):
     slug_name = slugify(temp_domain)
     return slug_name
 
+
+def json_dumps(values):
+    dthandler = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
+    return json.dumps(values, default=dthandler)
+
+
+def format_rows(rows, columns, fmt='text', text_fmt=None):
+    """ Serialize a list of dict for list commands
+        :param rows: list of dict
+        :param columns: ordered list of keys to output
+        :param fmt: output format: 'text', 'json' or 'tsv'
+        :param text_fmt: function returning the human readable line of a row (text format only)
+    """
+    if fmt == 'json':
+        return json_dumps([OrderedDict((col, row[col]) for col in columns) for row in rows])
+    if fmt == 'tsv':
+        def _tsv_value(value):
+            if value is None:
+                return ''
+            if isinstance(value, (list, tuple)):
+                return ','.join(value)
+            return '%s' % (value,)
+        lines = ['\t'.join(columns)]
+        lines += ['\t'.join(_tsv_value(row[col]) for col in columns) for row in rows]
+        return '\n'.join(lines)
+    if fmt == 'text':
+        text_fmt = text_fmt or (lambda row: row[columns[0]])
+        return '\n'.join(text_fmt(row) for row in rows)
+    raise ValueError('Unknown output format %s' % (fmt,))
+
+# ----------------------------------------------------------------------------
+# Metrics
+# ----------------------------------------------------------------------------
+
+METRICS_PATH = os.path.join(HERE, 'log', 'cloud_meta.prom')  # Prometheus textfile collector file
+METRICS_STATE_PATH = os.path.join(HERE, 'log', 'meta-metrics.json')  # aggregated values of all processes
+METRICS_SPOOL_PATH = os.path.join(HERE, 'log', 'meta-metrics.spool')  # values of the cli processes, not aggregated yet
+METRICS_SPOOL_MAX = 256 * 1024  # spool size from which a cli process aggregates it (no daemon running)
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_FLUSH_INTERVAL = 30
+SLOW_QUERY_MS = 200
+
+_METRICS_HELP = OrderedDict([
+    ('cloud_meta_command_duration_seconds', ('histogram', 'Wall time of the cloud-meta commands')),
+    ('cloud_meta_query_duration_seconds', ('histogram', 'Wall time of the queries on the meta database, by calling function')),
+    ('cloud_meta_checkout_duration_seconds', ('histogram', 'Wall time to get a connection from the pool (connection included)')),
+    ('cloud_meta_query_rows_total', ('counter', 'Rows returned or affected by the queries, by calling function')),
+    ('cloud_meta_command_errors_total', ('counter', 'Failed cloud-meta commands')),
+])
+
+_METRICS = {}  # {(metric name, labels): histogram [bucket counts..., sum, count] or counter value}
+_METRICS_LOCK = threading.Lock()
+_COMMAND_STATS = threading.local()  # totals of the running command, for its log line
+
+
+def _metric_labels(labels):
+    return ','.join('%s="%s"' % (key, ('%s' % (value,)).replace('"', '\\"')) for key, value in sorted(labels.items()))
+
+
+def metric_observe(name, value, **labels):
+    """ Record a value (in seconds) in a histogram """
+    key = (name, _metric_labels(labels))
+    with _METRICS_LOCK:
+        histogram = _METRICS.setdefault(key, [0] * (len(METRICS_BUCKETS) + 2))
+        for index, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def metric_inc(name, value=1, **labels):
+    """ Increment a counter """
+    key = (name, _metric_labels(labels))
+    with _METRICS_LOCK:
+        _METRICS[key] = _METRICS.get(key, 0) + value
+
+
+def _command_stats_reset():
+    _COMMAND_STATS.queries = 0
+    _COMMAND_STATS.query_time = 0.0
+    _COMMAND_STATS.checkout_time = 0.0
+    _COMMAND_STATS.rows = 0
+
+
+def _query_done(function, duration, rows, query):
+    metric_observe('cloud_meta_query_duration_seconds', duration, function=function)
+    metric_inc('cloud_meta_query_rows_total', rows, function=function)
+    if hasattr(_COMMAND_STATS, 'queries'):
+        _COMMAND_STATS.queries += 1
+        _COMMAND_STATS.query_time += duration
+        _COMMAND_STATS.rows += rows
+    if duration * 1000 >= SLOW_QUERY_MS:
+        _logger.warning('slow_query function=%s duration_ms=%.3f rows=%d query=%s', function, duration * 1000, rows, ' '.join(query.split()))
+    elif _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug('query function=%s duration_ms=%.3f rows=%d', function, duration * 1000, rows)
+
+
+def _checkout_done(duration):
+    metric_observe('cloud_meta_checkout_duration_seconds', duration)
+    if hasattr(_COMMAND_STATS, 'checkout_time'):
+        _COMMAND_STATS.checkout_time += duration
+
+
+@contextlib.contextmanager
+def instrument_command(command, mode):
+    """ Time a cloud-meta command and write its log line with the totals of its queries
+        :param mode: how the command is answered: 'direct', 'snapshot', 'client' or 'daemon'
+    """
+    _command_stats_reset()
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        command_done(command, mode, time.time() - start, ok=ok)
+
+
+def command_done(command, mode, duration, ok=True):
+    """ Record the duration of a command and write its log line """
+    metric_observe('cloud_meta_command_duration_seconds', duration, command=command, mode=mode)
+    if not ok:
+        metric_inc('cloud_meta_command_errors_total', command=command, mode=mode)
+    if not hasattr(_COMMAND_STATS, 'queries'):
+        _command_stats_reset()
+    # the snapshot lookups can be run in shell loops, and the daemon logs the commands of its clients
+    level = logging.INFO if mode in ('direct', 'daemon') or not ok else logging.DEBUG
+    _logger.log(level, 'command=%s mode=%s status=%s duration_ms=%.3f queries=%d query_ms=%.3f checkout_ms=%.3f rows=%d',
+        command, mode, 'ok' if ok else 'error', duration * 1000, _COMMAND_STATS.queries, _COMMAND_STATS.query_time * 1000,
+        _COMMAND_STATS.checkout_time * 1000, _COMMAND_STATS.rows)
+
+
+def _metrics_take():
+    """ metrics recorded by this process since the last call """
+    with _METRICS_LOCK:
+        metrics = dict(_METRICS)
+        _METRICS.clear()
+    return metrics
+
+
+def metrics_spool(spool_path=METRICS_SPOOL_PATH):
+    """ Append the metrics recorded by this process to the spool, with a single small write and
+        without lock: cli processes do not pay for the aggregation, the daemon aggregates the spool
+        periodically. Without daemon, the process making the spool exceed METRICS_SPOOL_MAX does it.
+    """
+    metrics = _metrics_take()
+    if not metrics:
+        return
+    line = json.dumps([[name, labels, value] for (name, labels), value in metrics.items()]) + '\n'
+    fd = os.open(spool_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, line)
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    if size > METRICS_SPOOL_MAX:
+        metrics_flush()
+
+
+def _metrics_spool_read(spool_path):
+    """ Take the content of the spool: list of metrics dict, one per spooled process """
+    folding_path = '%s.%d.folding' % (spool_path, os.getpid())
+    try:
+        os.rename(spool_path, folding_path)
+    except OSError:  # empty spool
+        return []
+    result = []
+    with open(folding_path) as f:
+        for line in f:
+            try:
+                result.append(dict(((name, labels), value) for name, labels, value in json.loads(line)))
+            except ValueError:
+                _logger.warning('Invalid line in the metrics spool, ignored')
+    os.unlink(folding_path)
+    return result
+
+
+def metrics_flush(state_path=METRICS_STATE_PATH, prom_path=METRICS_PATH, spool_path=METRICS_SPOOL_PATH):
+    """ Add the metrics recorded by this process and the spooled ones to the aggregated state
+        shared by all the cloud-meta processes (under an exclusive lock), and rewrite the textfile
+        collector file from it.
+    """
+    import fcntl
+    with open(state_path, 'a+') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        metrics_list = [_metrics_take()] + _metrics_spool_read(spool_path)
+        if not any(metrics_list):
+            return
+        lock_file.seek(0)
+        try:
+            state = dict((tuple(key.split('\t', 1)), value) for key, value in json.loads(lock_file.read() or '{}').items())
+        except ValueError:
+            _logger.warning('Invalid metrics state %s, metrics are reset', state_path)
+            state = {}
+        for metrics in metrics_list:
+            for key, value in metrics.items():
+                if isinstance(value, list):
+                    previous = state.get(key) or [0] * len(value)
+                    state[key] = [a + b for a, b in zip(previous, value)]
+                else:
+                    state[key] = state.get(key, 0) + value
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(json.dumps(dict(('\t'.join(key), value) for key, value in state.items())))
+        lock_file.flush()
+
+        tmp_path = '%s.%d.tmp' % (prom_path, os.getpid())
+        with open(tmp_path, 'w') as prom:
+            prom.write(_metrics_render(state))
+        os.rename(tmp_path, prom_path)
+
+
+def _metrics_render(state):
+    """ Render the metrics in the Prometheus text exposition format """
+    lines = []
+    for name, (metric_type, doc) in _METRICS_HELP.items():
+        keys = sorted(key for key in state if key[0] == name)
+        if not keys:
+            continue
+        lines += ['# HELP %s %s' % (name, doc), '# TYPE %s %s' % (name, metric_type)]
+        for key in keys:
+            labels = key[1]
+            value = state[key]
+            if metric_type == 'counter':
+                lines.append('%s{%s} %s' % (name, labels, value))
+                continue
+            sep = ',' if labels else ''
+            for bound, count in zip(METRICS_BUCKETS, value):
+                lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, bound, count))
+            lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, sep, value[-1]))
+            lines.append('%s_sum{%s} %.6f' % (name, labels, value[-2]))
+            lines.append('%s_count{%s} %d' % (name, labels, value[-1]))
+    return '\n'.join(lines) + '\n'
+
 # ----------------------------------------------------------------------------
 # Database access
 # ----------------------------------------------------------------------------
@@ -86,22 +369,50 @@ _METAPOOL = {}
 MAX_CONN = 32
 META = 'meta'
 
+_CURSOR_FACTORY = []
+
+
+def _cursor_factory():
+    """ NamedTupleCursor timing its queries, defined on first use since psycopg2 is imported lazily """
+    if not _CURSOR_FACTORY:
+        from psycopg2.extras import NamedTupleCursor
+
+        class MetaCursor(NamedTupleCursor):
+            function = None  # name of the function using the cursor, label of the query metrics
+
+            def execute(self, query, vars=None):
+                start = time.time()
+                try:
+                    return super(MetaCursor, self).execute(query, vars)
+                finally:
+                    _query_done(self.function, time.time() - start, max(self.rowcount, 0), query)
+
+        _CURSOR_FACTORY.append(MetaCursor)
+    return _CURSOR_FACTORY[0]
+
+
 @contextlib.contextmanager
 def cursor(commit=True):
     global _METAPOOL
+    # frames: generator, contextmanager __enter__, then the function with the `with` statement
+    function = sys._getframe(2).f_code.co_name
     dbname = META
+    start = time.time()
     try:
         pool = _METAPOOL[dbname]
         cnx = pool.getconn()
     except KeyError, AttributeError:
+        from psycopg2.pool import ThreadedConnectionPool
         dsn = 'dbname=%s' % dbname
         pool = ThreadedConnectionPool(0, MAX_CONN, dsn)
         cnx = pool.getconn()
 
         # save the connection pool
         _METAPOOL[dbname] = pool
+    _checkout_done(time.time() - start)
 
-    cr = cnx.cursor(cursor_factory=NamedTupleCursor)
+    cr = cnx.cursor(cursor_factory=_cursor_factory())
+    cr.function = function
 
     try:
         to_commit = False
@@ -129,18 +440,41 @@ def account_info(name):
         data = lemp_info(name)
     elif service_type == 'odoo':
         raise Exception("Not implemented yet")
-    dthandler = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
-    return json.dumps(data, default=dthandler)
+    return json_dumps(data)
+
+
+def account_list():
+    """ Fetch all service accounts with their odoo version and databases in a single query
+        :rtype list of dict
+    """
+    with cursor() as cr:
+        cr.execute("""
+            SELECT
+                A.name AS name,
+                A.server_name AS server_name,
+                A.service_type AS service_type,
+                A.status AS status,
+                V.version AS version,
+                V.port AS port,
+                V.longpolling_port AS longpolling_port,
+                COALESCE(array_agg(D.name ORDER BY D.name) FILTER (WHERE D.id IS NOT NULL), '{}') AS databases
+            FROM service_account A
+                LEFT JOIN odoo_version V ON A.odoo_version_id = V.id
+                LEFT JOIN database D ON D.service_id = A.id
+            GROUP BY A.id, V.id
+            ORDER BY A.name
+        """)
+        return [row._asdict() for row in cr.fetchall()]
 
 
 def _account_add(domain, unix_user, unix_group, status='production', service_type='lemp', odoo_version_id=False):
     slug_name = domain2database(domain)
 
     with cursor() as cr:
-        cr.excute("""
-            INSERT INTO service_account (name, server_name, unix_user, unix_group, status, service_type)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (domain, slug_name, unix_user, unix_group, status, service_type))
+        cr.execute("""
+            INSERT INTO service_account (name, server_name, unix_user, unix_group, status, service_type, odoo_version_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, (domain, slug_name, unix_user, unix_group, status, service_type, odoo_version_id or None))
     return slug_name
 
 
@@ -194,6 +528,8 @@ def _odoo_compute_port(branch):
         raise RuntimeError('No version can be extract from branch nickname %s to determine its port' % (branch,))
     version = float(version_list[0])
     port = int(8069 + 100 * version)
+    if port + ODOO_LONGPOLLINGPORT_OFFSET >= ODOO_PORT_RANGE[0]:
+        raise RuntimeError('Port %s computed from branch nickname %s overlaps the allocated ports' % (port, branch))
     return port, port + ODOO_LONGPOLLINGPORT_OFFSET
 
 
@@ -232,6 +568,19 @@ def odoo_list_branches():
     return version_list
 
 
+def odoo_list_branches_info():
+    """ Fetch all branches with their ports in a single query
+        :rtype list of dict
+    """
+    with cursor() as cr:
+        cr.execute("""
+            SELECT version, port, longpolling_port
+            FROM odoo_version
+            ORDER BY id DESC
+        """)
+        return [row._asdict() for row in cr.fetchall()]
+
+
 def odoo_last_branch():
     version_list = odoo_list_branches()
     if version_list:
@@ -243,11 +592,12 @@ def odoo_add_version(version):
     # check if version already existing
     if version in odoo_list_branches():
         return False
-    # add version and compute its ports
-    port, longpolling_port = _odoo_compute_port(version)
+    # add version and reserve the ports of its main instance
     with cursor() as cr:
-        cr.execute("INSERT INTO odoo_version(version, port, longpolling_port) VALUES (%s, %s, %s) RETURNING id", (version, port, longpolling_port))
-        return cr.fetchone()[0]
+        cr.execute("INSERT INTO odoo_version(version) VALUES (%s) RETURNING id", (version,))
+        version_id = cr.fetchone()[0]
+        _odoo_reserve_instance(cr, version_id, version, 0)
+        return version_id
     return False
 
 
@@ -266,90 +616,1335 @@ def odoo_add_database(domain, version, dbname=False):
         version_id = data[0].id if data else None
 
         # create the service entry
-        cr.excute("""
-            INSERT INTO service_account (name, service_name, status, service_type, odoo_version_id) VALUES (%s, %s, 'production', 'odoo', %s) RETURNING id
-        """, (domain, dbname, version_id))
+        cr.execute("""
+            INSERT INTO service_account (name, server_name, unix_user, unix_group, status, service_type, odoo_version_id) VALUES (%s, %s, %s, %s, 'production', 'odoo', %s) RETURNING id
+        """, (domain, dbname, ODOO_UNIX_USER, ODOO_UNIX_USER, version_id))
         service_id = int(cr.fetchone()[0])
 
         # create the database entry
-        cr.excute("""
+        cr.execute("""
             INSERT INTO database (name, db_type, service_id) VALUES (%s, 'postgres', %s) RETURNING id
         """, (dbname, service_id))
-    return cr.fetchone()[0]
+        return cr.fetchone()[0]
+
+
+_ODOO_DB_INFO_QUERY = """
+    SELECT
+        A.name AS service_name,
+        A.status AS status,
+        V.version AS version,
+        D.name AS dbname,
+        A.create_date AS create_date,
+        A.update_date AS update_date,
+        V.port AS port,
+        V.longpolling_port AS longpolling_port
+    FROM database D
+        LEFT JOIN service_account A ON D.service_id = A.id
+        LEFT JOIN odoo_version V ON A.odoo_version_id = V.id
+"""
 
 
 def odoo_get_info(dbname):
     db_values = {}
     with cursor() as cr:
-        cr.execute("""
-            SELECT
-                A.name AS service_name,
-                A.status AS status,
-                V.version AS version,
-                D.name AS dbname,
-                S.create_date AS create_date,
-                S.update_date AS update_date,
-                D.port AS port,
-                D.longpolling_port AS longpolling_port
-            FROM database D
-                LEFT JOIN service_account A ON D.service_id = D.id
-                LEFT JOIN odoo_version V ON A.odoo_version_id = V.id
+        cr.execute(_ODOO_DB_INFO_QUERY + """
             WHERE D.name = %s
             LIMIT 1
         """, (dbname,))
         dbinfo = cr.fetchall()[0]
         db_values = dbinfo._asdict()
 
-    dthandler = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
-    return json.dumps(db_values, default=dthandler)
+    return json_dumps(db_values)
 
 
-def main():
+# ----------------------------------------------------------------------------
+# Port allocation
+# ----------------------------------------------------------------------------
+
+# first free port of the range: either its lower bound, or right after a reserved port
+_FREE_PORT_QUERY = """
+    SELECT C.port
+    FROM (
+        SELECT %(low)s AS port
+        UNION ALL
+        SELECT port + 1 FROM port_reservation WHERE port >= %(low)s AND port < %(high)s
+    ) C
+    WHERE NOT EXISTS (SELECT 1 FROM port_reservation R WHERE R.port = C.port)
+    ORDER BY C.port
+    LIMIT 1
+"""
+
+
+def _port_allocate(cr, version_id, instance, purpose, preferred=None):
+    """ Reserve a port for the given instance of a version. The table is locked until the end of
+        the transaction so concurrent allocations are serialized (readers are not blocked), and the
+        primary key on the port guarantees no port is given twice.
+        :param preferred: port to reserve if it is still free
+        :returns the reserved port
     """
-        Usage:
-            cloud-meta info <name>
-            cloud-meta odoo-get-info <dbname>
-            cloud-meta odoo-get-port <branch>
-            cloud-meta odoo-get-longpolling-port <branch>
-            cloud-meta odoo-list-branches [-a] [-p]
-            cloud-meta odoo-last-branch [-a]
-            cloud-meta odoo-add-version <version>
-            cloud-meta odoo-add-database <url> <version> [-d <database>]
+    cr.execute("LOCK TABLE port_reservation IN SHARE ROW EXCLUSIVE MODE")
+    if preferred:
+        cr.execute("""
+            INSERT INTO port_reservation (port, odoo_version_id, instance, purpose) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (port) DO NOTHING
+            RETURNING port
+        """, (preferred, version_id, instance, purpose))
+        data = cr.fetchall()
+        if data:
+            return data[0].port
+        _logger.warning('Port %s already reserved, allocating %s port of instance %s elsewhere', preferred, purpose, instance)
+    cr.execute(_FREE_PORT_QUERY, {'low': ODOO_PORT_RANGE[0], 'high': ODOO_PORT_RANGE[1]})
+    data = cr.fetchall()
+    if not data or data[0].port > ODOO_PORT_RANGE[1]:
+        raise RuntimeError('No free port left between %s and %s' % ODOO_PORT_RANGE)
+    cr.execute("""
+        INSERT INTO port_reservation (port, odoo_version_id, instance, purpose) VALUES (%s, %s, %s, %s)
+        RETURNING port
+    """, (data[0].port, version_id, instance, purpose))
+    return cr.fetchone()[0]
+
+
+def _odoo_reserve_instance(cr, version_id, version, instance, port=None, longpolling_port=None):
+    """ Reserve the http and longpolling ports of an instance. The main instance (0) prefers the
+        given ports, or the ones computed from the version, and they are written on odoo_version.
+        :returns tuple (port, longpolling_port)
     """
-    from docopt import docopt
-    import signal
+    if instance == 0 and not port:
+        try:
+            port, longpolling_port = _odoo_compute_port(version)
+        except RuntimeError:
+            pass
+    port = _port_allocate(cr, version_id, instance, ODOO_PORT_HTTP, preferred=port)
+    longpolling_port = _port_allocate(cr, version_id, instance, ODOO_PORT_LONGPOLLING, preferred=longpolling_port)
+    if instance == 0:
+        cr.execute("UPDATE odoo_version SET port = %s, longpolling_port = %s WHERE id = %s", (port, longpolling_port, version_id))
+    return port, longpolling_port
+
+
+def _odoo_version_id(cr, version):
+    cr.execute("SELECT id FROM odoo_version WHERE version = %s", (version,))
+    data = cr.fetchall()
+    if not data:
+        raise RuntimeError('Unknown odoo version %s' % (version,))
+    return data[0].id
+
+
+def odoo_add_instance(version):
+    """ Add an instance of a version (e.g. a second one during an upgrade) and reserve its ports
+        :rtype dict with version, instance, port and longpolling_port
+    """
+    with cursor() as cr:
+        version_id = _odoo_version_id(cr, version)
+        cr.execute("LOCK TABLE port_reservation IN SHARE ROW EXCLUSIVE MODE")
+        cr.execute("SELECT COALESCE(MAX(instance) + 1, 0) AS instance FROM port_reservation WHERE odoo_version_id = %s", (version_id,))
+        instance = cr.fetchone().instance
+        port, longpolling_port = _odoo_reserve_instance(cr, version_id, version, instance)
+    return OrderedDict([('version', version), ('instance', instance), ('port', port), ('longpolling_port', longpolling_port)])
 
-    if os.getuid() != 0:  # TODO: this might not be a good practice
-        sys.exit("cloud-meta must be run as root")
 
-    signal.signal(signal.SIGINT, _sigint_handler)
+def odoo_reserve_port(version, purpose, instance=0):
+    """ Reserve an extra port (e.g. for a sidecar) for an instance of a version
+        :returns the reserved port
+    """
+    with cursor() as cr:
+        version_id = _odoo_version_id(cr, version)
+        return _port_allocate(cr, version_id, instance, purpose)
+
+
+def odoo_release_instance(version, instance):
+    """ Release all the ports of an extra instance of a version. The main instance is only
+        released with its version.
+        :returns the list of released ports
+    """
+    if instance == 0:
+        raise RuntimeError('The main instance of %s can not be released' % (version,))
+    with cursor() as cr:
+        version_id = _odoo_version_id(cr, version)
+        cr.execute("""
+            DELETE FROM port_reservation
+            WHERE odoo_version_id = %s AND instance = %s
+            RETURNING port
+        """, (version_id, instance))
+        return sorted(r.port for r in cr.fetchall())
+
+
+def odoo_list_ports(version=None):
+    """ Fetch the reserved ports, of all versions or of the given one
+        :rtype list of dict
+    """
+    with cursor() as cr:
+        cr.execute("""
+            SELECT V.version, R.instance, R.purpose, R.port
+            FROM port_reservation R
+                JOIN odoo_version V ON R.odoo_version_id = V.id
+            WHERE %s IS NULL OR V.version = %s
+            ORDER BY V.id DESC, R.instance, R.port
+        """, (version, version))
+        return [row._asdict() for row in cr.fetchall()]
+
+
+# ----------------------------------------------------------------------------
+# Schema migrations
+# ----------------------------------------------------------------------------
+
+MIGRATIONS_DIR = os.path.join(HERE, 'resources', 'migrations')
+MIGRATION_LOCK_ID = 4242  # advisory lock preventing concurrent migrations
+MIGRATION_LOCK_TIMEOUT = '5s'
+MIGRATION_NO_TRANSACTION = '-- migration: no-transaction'
+_CONCURRENT_INDEX_RE = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+
+def _migration_drop_invalid_index(cr, name):
+    """ Drop the index if a failed CREATE INDEX CONCURRENTLY left it INVALID: `IF NOT EXISTS` would
+        skip it on the next run, and the index would never be usable.
+        :returns True if the index was dropped
+    """
+    cr.execute("""
+        SELECT 1
+        FROM pg_index I
+            JOIN pg_class C ON C.oid = I.indexrelid
+        WHERE C.relname = %s AND NOT I.indisvalid
+    """, (name,))
+    if not cr.fetchall():
+        return False
+    _logger.warning('Dropping the invalid index %s', name)
+    cr.execute('DROP INDEX CONCURRENTLY IF EXISTS "%s"' % (name,))
+    return True
+
+
+def meta_migrate(migrations_dir=MIGRATIONS_DIR, until=None, exclude=()):
+    """ Apply the migrations of the meta schema not applied yet, in the order of their file name. The
+        applied versions (file name without extension) are recorded in the `meta_migration` table.
+        Each migration runs in its own transaction, unless its first line is
+        `-- migration: no-transaction` (e.g. for CREATE INDEX CONCURRENTLY): it must then contain
+        a single statement. An index left INVALID by a failed CREATE INDEX CONCURRENTLY is dropped,
+        so it is built again by the next run. Locks are awaited at most MIGRATION_LOCK_TIMEOUT, so
+        that a migration never queues the lookups behind it for long.
+        :param migrations_dir: absolute path of the directory containing the .sql migration files
+        :param until: last version to apply (all versions if not given)
+        :param exclude: versions not to apply (they stay pending)
+        :returns the list of applied versions
+    """
+    import psycopg2
+    applied = []
+    cnx = psycopg2.connect('dbname=%s' % (META,))
+    cnx.autocommit = True
+    cr = cnx.cursor()
+    try:
+        cr.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        cr.execute("SET lock_timeout = %s", (MIGRATION_LOCK_TIMEOUT,))
+        cr.execute("""
+            CREATE TABLE IF NOT EXISTS meta_migration(
+                version varchar PRIMARY KEY,
+                apply_date timestamp without time zone DEFAULT NOW()
+            )
+        """)
+        cr.execute("SELECT version FROM meta_migration")
+        done = set(row[0] for row in cr.fetchall())
+
+        for filename in sorted(os.listdir(migrations_dir)):
+            version, ext = os.path.splitext(filename)
+            if ext != '.sql' or version in done or version in exclude:
+                continue
+            if until and version > until:
+                break
+            with open(os.path.join(migrations_dir, filename)) as f:
+                query = f.read()
+            _logger.info('Applying migration %s', version)
+            if query.startswith(MIGRATION_NO_TRANSACTION):
+                match = _CONCURRENT_INDEX_RE.search(query)
+                index = match.group(1) if match else None
+                if index:
+                    _migration_drop_invalid_index(cr, index)  # left by an interrupted run
+                try:
+                    cr.execute(query)
+                except psycopg2.Error:
+                    if index:
+                        try:
+                            _migration_drop_invalid_index(cr, index)
+                        except psycopg2.Error:
+                            _logger.exception('Error while dropping the invalid index %s, it will be dropped on the next run', index)
+                    raise
+                cr.execute("INSERT INTO meta_migration (version) VALUES (%s)", (version,))
+            else:
+                cnx.autocommit = False
+                try:
+                    cr.execute(query)
+                    cr.execute("INSERT INTO meta_migration (version) VALUES (%s)", (version,))
+                    cnx.commit()
+                except Exception:
+                    cnx.rollback()
+                    raise
+                finally:
+                    cnx.autocommit = True
+            applied.append(version)
+    finally:
+        try:
+            cr.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        finally:
+            cnx.close()
+    return applied
+
+
+# ----------------------------------------------------------------------------
+# Snapshot (local read-only copy of the meta database)
+# ----------------------------------------------------------------------------
+
+def meta_generation():
+    """ Return the generation counter of the meta database, bumped on every change of its tables """
+    with cursor(commit=False) as cr:
+        cr.execute("SELECT generation FROM meta_generation WHERE id = 1")
+        data = cr.fetchall()
+        return data[0].generation if data else None
+
+
+def snapshot_generation(path=SNAPSHOT_PATH):
+    """ Return the generation of the meta database the snapshot was built from, or None if no snapshot """
+    import sqlite3
+    if not os.path.isfile(path):
+        return None
+    try:
+        cnx = sqlite3.connect(path)
+        try:
+            row = cnx.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        finally:
+            cnx.close()
+    except sqlite3.Error:
+        return None
+    return int(row[0]) if row else None
+
+
+def snapshot_refresh(path=SNAPSHOT_PATH, force=False):
+    """ (Re)build the sqlite snapshot of the meta database if its generation changed. The file is
+        written aside and atomically renamed, so readers never see a partial snapshot. If the
+        generation did not change, the modification time of the snapshot is updated: it is the
+        time of its last check (see `snapshot_expired`).
+        :param path: absolute path of the snapshot file
+        :param force: rebuild the snapshot even if the generation did not change
+        :returns True if the snapshot was (re)built
+    """
+    with _snapshot_lock:
+        return _snapshot_refresh(path, force)
+
+
+def _snapshot_refresh(path, force):
+    import sqlite3
+    with cursor(commit=False) as cr:
+        cr.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cr.execute("SELECT generation, update_date FROM meta_generation WHERE id = 1")
+        data = cr.fetchall()
+        generation = data[0].generation if data else 0
+        if not force and snapshot_generation(path) == generation:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            return False
+
+        cr.execute("SELECT version, port, longpolling_port FROM odoo_version")
+        versions = [(v.version, v.port, v.longpolling_port) for v in cr.fetchall()]
+        cr.execute("""
+            SELECT name, server_name, unix_user, unix_group, service_type, status, create_date, update_date
+            FROM service_account
+        """)
+        accounts = [(a.name, a.service_type, json_dumps(a._asdict())) for a in cr.fetchall()]
+        cr.execute(_ODOO_DB_INFO_QUERY)
+        databases = [(d.dbname, json_dumps(d._asdict())) for d in cr.fetchall()]
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    cnx = sqlite3.connect(tmp_path)
+    try:
+        cnx.executescript("""
+            CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE odoo_version(version TEXT PRIMARY KEY, port INTEGER, longpolling_port INTEGER);
+            CREATE TABLE account(name TEXT PRIMARY KEY, service_type TEXT, info TEXT);
+            CREATE TABLE database(name TEXT PRIMARY KEY, info TEXT);
+        """)
+        cnx.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ('generation', '%s' % (generation,)),
+            ('create_date', datetime.datetime.now().isoformat()),
+        ])
+        cnx.executemany("INSERT INTO odoo_version VALUES (?, ?, ?)", versions)
+        cnx.executemany("INSERT INTO account VALUES (?, ?, ?)", accounts)
+        cnx.executemany("INSERT OR IGNORE INTO database VALUES (?, ?)", databases)
+        cnx.commit()
+    finally:
+        cnx.close()
+    os.chmod(tmp_path, 0o600)
+    os.rename(tmp_path, path)
+    _logger.info('Snapshot of generation %s written in %s', generation, path)
+    return True
 
-    opt = docopt(main.__doc__)
 
+def snapshot_expired(path=SNAPSHOT_PATH):
+    """ Whether the snapshot is missing, or was not checked against the meta database for more than
+        SNAPSHOT_MAX_AGE seconds (changes made outside of cloud-meta are not seen without the daemon)
+    """
+    try:
+        return time.time() - os.stat(path).st_mtime > SNAPSHOT_MAX_AGE
+    except OSError:
+        return True
+
+
+def snapshot_lookup(opt, path=SNAPSHOT_PATH):
+    """ Answer a read command from the snapshot
+        :param opt: parsed docopt options
+        :returns the command output as a string, or None if the snapshot can not answer it
+    """
+    if snapshot_expired(path):
+        return None
+    if opt['odoo-get-port']:
+        query, params = "SELECT port FROM odoo_version WHERE version = ?", (opt['<branch>'],)
+    elif opt['odoo-get-longpolling-port']:
+        query, params = "SELECT longpolling_port FROM odoo_version WHERE version = ?", (opt['<branch>'],)
+    elif opt['odoo-get-info']:
+        query, params = "SELECT info FROM database WHERE name = ?", (opt['<dbname>'],)
+    elif opt['info']:
+        query, params = "SELECT info FROM account WHERE name = ? AND service_type IN ('lemp', 'wordpress')", (opt['<name>'],)
+    else:
+        return None
+    import sqlite3
+    try:
+        cnx = sqlite3.connect(path)
+        try:
+            row = cnx.execute(query, params).fetchone()
+        finally:
+            cnx.close()
+    except sqlite3.Error:
+        return None
+    if not row or row[0] is None:
+        return None
+    return '%s' % (row[0],)
+
+
+# ----------------------------------------------------------------------------
+# Bulk import
+# ----------------------------------------------------------------------------
+
+IMPORT_PAGE_SIZE = 500
+
+
+def _import_read_records(path):
+    """ Read the records to import from a JSONL or CSV file (one record per line/row, with a `type`
+        key among 'version', 'port', 'account' and 'database'). Empty values are considered as missing.
+        :param path: file path (extension .csv for CSV, JSONL otherwise), or '-' for JSONL on stdin
+        :rtype list of tuple (line number, record dict)
+    """
+    import csv
+    stream = sys.stdin if path == '-' else open(path)
+    try:
+        if path.endswith('.csv'):
+            reader = csv.DictReader(stream, restkey=None)  # values beyond the header are under the key None
+            records = [(index + 2, row) for index, row in enumerate(reader)]  # line 1 is the header
+        else:
+            records = []
+            for index, line in enumerate(stream):
+                if line.strip():
+                    try:
+                        records.append((index + 1, json.loads(line)))
+                    except ValueError as e:
+                        records.append((index + 1, {'__error__': 'invalid json: %s' % (e,)}))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return [(lineno, _import_normalize(record)) for lineno, record in records]
+
+
+def _import_normalize(record):
+    """ Record with stripped lower case keys and without the empty values, or with a key `__error__`
+        if it is not a proper record
+    """
+    if not isinstance(record, dict):
+        return {'__error__': 'not an object: %s' % (json_dumps(record),)}
+    if None in record:
+        return {'__error__': 'more values than columns'}
+    nested = sorted(k for k, v in record.items() if isinstance(v, (dict, list)))
+    if nested:
+        return {'__error__': 'not a single value: %s' % (', '.join(nested),)}
+    return dict((k.strip().lower(), v) for k, v in record.items() if v not in (None, ''))
+
+
+def _import_int(record, key):
+    """ Integer value of the key of the record (None if missing)
+        :raises ValueError: if the value is not an integer
+    """
+    value = record.get(key)
+    if value is None:
+        return None
+    try:
+        return int('%s' % (value,))
+    except ValueError:
+        raise ValueError('invalid %s: %s' % (key, value))
+
+
+def _import_batch(cr, query, template, rows):
+    """ Execute a multi-row INSERT by pages of IMPORT_PAGE_SIZE rows
+        :param query: INSERT query with a single `%s` placeholder for the VALUES list, and a RETURNING clause
+        :param template: template of one row of values (e.g. '(%s, %s)')
+        :param rows: list of tuple of values
+        :returns the rows returned by all the pages
+    """
+    result = []
+    for index in range(0, len(rows), IMPORT_PAGE_SIZE):
+        values = ','.join(cr.mogrify(template, row) for row in rows[index:index + IMPORT_PAGE_SIZE])
+        cr.execute(query % (values,))
+        result += cr.fetchall()
+    return result
+
+
+def meta_import(path, update=False):
+    """ Import versions, accounts and databases in a single transaction, with batched multi-row
+        inserts. Versions are loaded first, then extra ports, accounts and databases, whatever their
+        order in the file. Existing entries (same version, port, account name or database name and
+        type) are skipped, or updated if `update` is set (accounts and databases only). The given
+        ports of a version are reserved if free, otherwise other ones are allocated.
+        :param path: JSONL or CSV file to import (see `_import_read_records`)
+        :param update: update the existing entries instead of skipping them
+        :returns the report: list of dict with line, type, name, result ('created', 'updated',
+            'skipped' or 'error') and message
+    """
+    report = {}
+    versions, accounts, databases, ports = [], [], [], []
+
+    def _report(lineno, record_type, name, result, message=''):
+        report[lineno] = {'line': lineno, 'type': record_type, 'name': name, 'result': result, 'message': message}
+
+    # values accepted by the enum columns, so that a bad value is reported on its row
+    with cursor(commit=False) as cr:
+        cr.execute("""
+            SELECT T.typname, array_agg(E.enumlabel::text) AS labels
+            FROM pg_enum E
+                JOIN pg_type T ON E.enumtypid = T.oid
+            WHERE T.typname IN ('service_status_type', 'service_type_type', 'db_type_type')
+            GROUP BY T.typname
+        """)
+        enums = dict((row.typname, set(row.labels)) for row in cr.fetchall())
+
+    def _check_enum(record, key, default, type_name):
+        value = record.get(key, default)
+        if value not in enums.get(type_name, ()):
+            raise ValueError('invalid %s: %s' % (key, value))
+        return value
+
+    # validate the records
+    seen = set()
+    for lineno, record in _import_read_records(path):
+        record_type = record.get('type')
+        name = record.get('version') if record_type in ('version', 'port') else record.get('name')
+        if record_type == 'database':
+            key = (record_type, name, record.get('db_type', 'postgres'))
+        elif record_type == 'port':
+            key = (record_type, name, (record.get('instance') or 0, record.get('purpose')))
+        else:
+            key = (record_type, name, None)
+        try:
+            if record.get('__error__'):
+                _report(lineno, record_type, name, 'error', record['__error__'])
+            elif name and key in seen:
+                _report(lineno, record_type, name, 'error', 'duplicated in the imported file')
+            elif record_type == 'version':
+                if not name:
+                    _report(lineno, record_type, name, 'error', 'missing version')
+                    continue
+                port = _import_int(record, 'port')
+                longpolling_port = _import_int(record, 'longpolling_port')
+                versions.append((lineno, (name, port, longpolling_port)))
+            elif record_type == 'port':
+                if not name or not record.get('purpose') or not record.get('port'):
+                    _report(lineno, record_type, name, 'error', 'missing version, purpose or port')
+                else:
+                    ports.append((lineno, (name, _import_int(record, 'instance') or 0, record['purpose'], _import_int(record, 'port'))))
+            elif record_type == 'account':
+                service_type = _check_enum(record, 'service_type', 'lemp', 'service_type_type')
+                unix_user = record.get('unix_user', ODOO_UNIX_USER if service_type == 'odoo' else None)
+                unix_group = record.get('unix_group', unix_user)
+                if not name or not unix_user:
+                    _report(lineno, record_type, name, 'error', 'missing name or unix_user')
+                elif service_type == 'odoo' and not record.get('version'):
+                    _report(lineno, record_type, name, 'error', 'odoo account requires a version')
+                else:
+                    server_name = record.get('server_name', domain2database(name))
+                    status = _check_enum(record, 'status', 'production', 'service_status_type')
+                    accounts.append((lineno, (name, server_name, unix_user, unix_group, status, service_type, record.get('version'))))
+            elif record_type == 'database':
+                if not name or not record.get('account'):
+                    _report(lineno, record_type, name, 'error', 'missing name or account')
+                else:
+                    databases.append((lineno, (name, _check_enum(record, 'db_type', 'postgres', 'db_type_type'), record['account'])))
+            else:
+                _report(lineno, record_type, name, 'error', 'unknown record type %r' % (record_type,))
+        except ValueError as e:  # values of the wrong type
+            _report(lineno, record_type, name, 'error', '%s' % (e,))
+        seen.add(key)
+
+    def _report_batch(record_type, entries, returned, key_size=1):
+        """ report the result of the entries from the RETURNING (key..., inserted) rows of their batch """
+        returned = dict((tuple(row[:key_size]), row[key_size]) for row in returned)
+        for lineno, values in entries:
+            key = tuple(values[:key_size])
+            if key not in returned:
+                _report(lineno, record_type, values[0], 'skipped', 'already exists')
+            else:
+                _report(lineno, record_type, values[0], 'created' if returned[key] else 'updated')
+
+    with cursor() as cr:
+        # versions (insert the missing ones only), then reserve the ports of their main instance
+        rows = _import_batch(cr, """
+            INSERT INTO odoo_version (version)
+            SELECT v.version
+            FROM (VALUES %s) v(version)
+            ON CONFLICT (version) DO NOTHING
+            RETURNING version, true, id
+        """, '(%s)', [values[:1] for lineno, values in versions])
+        _report_batch('version', versions, rows)
+        version_ids = dict((row[0], row[2]) for row in rows)
+        for lineno, (name, port, longpolling_port) in versions:
+            if name in version_ids:
+                port, longpolling_port = _odoo_reserve_instance(cr, version_ids[name], name, 0, port=port, longpolling_port=longpolling_port)
+                report[lineno]['message'] = 'ports %s, %s' % (port, longpolling_port)
+
+        # extra ports, of any instance: the ones of unknown versions are rejected
+        cr.execute("SELECT version FROM odoo_version")
+        known_versions = set(v.version for v in cr.fetchall())
+        valid_ports = []
+        for lineno, values in ports:
+            if values[0] not in known_versions:
+                _report(lineno, 'port', values[0], 'error', 'unknown version %s' % (values[0],))
+            else:
+                valid_ports.append((lineno, values))
+        rows = _import_batch(cr, """
+            INSERT INTO port_reservation (port, odoo_version_id, instance, purpose)
+            SELECT p.port, V.id, p.instance, p.purpose
+            FROM (VALUES %s) p(version, instance, purpose, port)
+                JOIN odoo_version V ON V.version = p.version
+            ON CONFLICT DO NOTHING
+            RETURNING (SELECT version FROM odoo_version WHERE id = odoo_version_id), instance, purpose, true
+        """, '(%s, %s::integer, %s, %s::integer)', [values for lineno, values in valid_ports])
+        _report_batch('port', valid_ports, rows, key_size=3)
+        # a port not inserted is skipped only if it is the one already reserved for this purpose
+        cr.execute("""
+            SELECT R.port, V.version, R.instance, R.purpose
+            FROM port_reservation R
+                JOIN odoo_version V ON R.odoo_version_id = V.id
+        """)
+        reserved = dict((row.port, (row.version, row.instance, row.purpose)) for row in cr.fetchall())
+        reserved_by_key = dict((key, port) for port, key in reserved.items())
+        for lineno, (name, instance, purpose, port) in valid_ports:
+            if report[lineno]['result'] != 'skipped' or reserved.get(port) == (name, instance, purpose):
+                continue
+            if (name, instance, purpose) in reserved_by_key:
+                message = '%s #%s %s already has port %s' % (name, instance, purpose, reserved_by_key[(name, instance, purpose)])
+            else:
+                message = 'port %s already reserved by %s #%s %s' % ((port,) + reserved[port])
+            _report(lineno, 'port', name, 'error', message)
+
+        # accounts of unknown version are rejected before violating the check constraint
+        valid_accounts = []
+        for lineno, values in accounts:
+            if values[6] and values[6] not in known_versions:
+                _report(lineno, 'account', values[0], 'error', 'unknown version %s' % (values[6],))
+            else:
+                valid_accounts.append((lineno, values))
+        conflict = """DO UPDATE SET
+                server_name = EXCLUDED.server_name, unix_user = EXCLUDED.unix_user, unix_group = EXCLUDED.unix_group,
+                status = EXCLUDED.status, service_type = EXCLUDED.service_type, odoo_version_id = EXCLUDED.odoo_version_id
+        """ if update else "DO NOTHING"
+        rows = _import_batch(cr, """
+            INSERT INTO service_account (name, server_name, unix_user, unix_group, status, service_type, odoo_version_id)
+            SELECT a.name, a.server_name, a.unix_user, a.unix_group, a.status::service_status_type, a.service_type::service_type_type, V.id
+            FROM (VALUES %%s) a(name, server_name, unix_user, unix_group, status, service_type, version)
+                LEFT JOIN odoo_version V ON V.version = a.version
+            ON CONFLICT (name) %s
+            RETURNING name, xmax = 0
+        """ % (conflict,), '(%s, %s, %s, %s, %s, %s, %s)', [values for lineno, values in valid_accounts])
+        _report_batch('account', valid_accounts, rows)
+
+        # databases of unknown account are rejected
+        cr.execute("SELECT name FROM service_account")
+        known_accounts = set(a.name for a in cr.fetchall())
+        valid_databases = []
+        for lineno, values in databases:
+            if values[2] not in known_accounts:
+                _report(lineno, 'database', values[0], 'error', 'unknown account %s' % (values[2],))
+            else:
+                valid_databases.append((lineno, values))
+        conflict = "DO UPDATE SET service_id = EXCLUDED.service_id" if update else "DO NOTHING"
+        rows = _import_batch(cr, """
+            INSERT INTO database (name, db_type, service_id)
+            SELECT d.name, d.db_type::db_type_type, A.id
+            FROM (VALUES %%s) d(name, db_type, account)
+                JOIN service_account A ON A.name = d.account
+            ON CONFLICT (name, db_type) %s
+            RETURNING name, db_type, xmax = 0
+        """ % (conflict,), '(%s, %s, %s)', [values for lineno, values in valid_databases])
+        _report_batch('database', valid_databases, rows, key_size=2)
+
+    return [report[lineno] for lineno in sorted(report)]
+
+
+# ----------------------------------------------------------------------------
+# Streaming export
+# ----------------------------------------------------------------------------
+
+EXPORT_BATCH_SIZE = 2000
+
+# records are exported in the format read by `meta_import`
+_EXPORT_QUERIES = [
+    ('version', """
+        SELECT version, port, longpolling_port
+        FROM odoo_version
+        ORDER BY id
+    """),
+    ('port', """
+        SELECT V.version, R.instance, R.purpose, R.port
+        FROM port_reservation R
+            JOIN odoo_version V ON R.odoo_version_id = V.id
+        WHERE R.instance != 0 OR R.purpose NOT IN ('http', 'longpolling')
+        ORDER BY R.port
+    """),
+    ('account', """
+        SELECT A.name, A.server_name, A.unix_user, A.unix_group, A.status, A.service_type, V.version, A.create_date, A.update_date
+        FROM service_account A
+            LEFT JOIN odoo_version V ON A.odoo_version_id = V.id
+        ORDER BY A.id
+    """),
+    ('database', """
+        SELECT D.name, D.db_type, A.name AS account
+        FROM database D
+            JOIN service_account A ON D.service_id = A.id
+        ORDER BY D.id
+    """),
+]
+
+
+def meta_export(stream, batch_size=EXPORT_BATCH_SIZE):
+    """ Write all versions, accounts and databases as JSONL records on the given stream. Rows are
+        fetched through server-side cursors by batches of `batch_size`, so the memory usage does not
+        depend on the number of tenants. All records come from the same snapshot of the database.
+        :param stream: file-like object to write on
+        :returns the number of exported records
+    """
+    from psycopg2.extras import NamedTupleCursor
+    count = 0
+    with cursor(commit=False) as cr:
+        cr.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        for record_type, query in _EXPORT_QUERIES:
+            named_cr = cr.connection.cursor('meta_export_%s' % (record_type,), cursor_factory=NamedTupleCursor)
+            try:
+                named_cr.itersize = batch_size
+                named_cr.execute(query)
+                while True:
+                    rows = named_cr.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        values = OrderedDict([('type', record_type)])
+                        values.update(row._asdict())
+                        stream.write(json_dumps(values) + '\n')
+                    count += len(rows)
+            finally:
+                named_cr.close()
+    stream.flush()
+    return count
+
+
+# ----------------------------------------------------------------------------
+# Batch operations (fleet wide maintenance)
+# ----------------------------------------------------------------------------
+
+BATCH_JOBS = 4
+NGINX_TEMPLATE = os.path.join(HERE, 'resources', 'nginx_openerp.tpl')
+NGINX_SITES_AVAILABLE = '/etc/nginx/sites-availables'
+NGINX_SITES_ENABLED = '/etc/nginx/sites-enabled'
+NGINX_UPSTREAM_TEMPLATE = os.path.join(HERE, 'resources', 'nginx_upstream_openerp.tpl')
+NGINX_UPSTREAM_PATH = '/etc/nginx/conf.d/odoo-%s.conf'  # upstreams of a version, shared by its sites
+
+
+class BatchError(Exception):
+    """ Raised by the batch commands when some items were not processed: carries the formatted report """
+
+    def __init__(self, message, output):
+        super(BatchError, self).__init__(message)
+        self.output = output
+
+
+@graceful_stop
+def batch_run(name, items, func, jobs=BATCH_JOBS):
+    """ Apply `func` on each item with at most `jobs` concurrent threads, printing the progress on
+        stderr. On Ctrl-C, no new item is dispatched but the running ones are finished; the items
+        not dispatched are reported as skipped.
+        :param name: name of the batch, for the logs
+        :param items: list of tuple (key, item)
+        :param func: function applied on an item, returning an optional message
+        :returns the report: list of dict with key, result ('ok', 'error' or 'skipped'), duration (ms)
+            and message, in the order of the items
+    """
+    report = {}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max(1, jobs))
+    threads = []
+
+    def _work(key, item):
+        start = time.time()
+        try:
+            result, message = 'ok', func(item) or ''
+        except Exception as e:
+            _logger.exception('Batch %s failed on %s', name, key)
+            result, message = 'error', '%s' % (e,)
+        finally:
+            slots.release()
+        duration = (time.time() - start) * 1000
+        with lock:
+            report[key] = {'key': key, 'result': result, 'duration': round(duration, 1), 'message': message}
+            sys.stderr.write('[%d/%d] %s %s (%.0f ms)\n' % (len(report), len(items), key, result, duration))
+
+    start = time.time()
+    for key, item in check_stop(items):
+        slots.acquire()
+        if stopped():  # Ctrl-C while waiting for a free slot
+            slots.release()
+            break
+        thread = threading.Thread(target=_work, args=(key, item), name='batch-%s' % (name,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    for key, item in items:
+        report.setdefault(key, {'key': key, 'result': 'skipped', 'duration': 0, 'message': 'stopped'})
+    counts = dict((result, sum(1 for r in report.values() if r['result'] == result)) for result in ['ok', 'error', 'skipped'])
+    _logger.info('batch=%s jobs=%s duration_ms=%.3f ok=%d error=%d skipped=%d',
+        name, jobs, (time.time() - start) * 1000, counts['ok'], counts['error'], counts['skipped'])
+    return [report[key] for key, item in items]
+
+
+def _batch_check_call(args):
+    import subprocess
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError('%s failed: %s' % (' '.join(args), output.strip()))
+    return output.strip()
+
+
+def _write_if_changed(path, content, backup=None):
+    """ Atomically replace the file at `path` by `content`, unless it already has this content
+        :param backup: optional dict {path: previous content, or None if there was no file}, filled
+            with the previous content of the file if it is written (see `_nginx_restore`)
+        :returns True if the file was written
+    """
+    previous = None
+    try:
+        with open(path) as f:
+            previous = f.read()
+    except IOError:
+        pass
+    if previous == content:
+        return False
+    if backup is not None:
+        backup.setdefault(path, previous)
+    tmp_path = '%s.tmp' % (path,)
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+    return True
+
+
+def _nginx_reload():
+    _batch_check_call(['nginx', '-t', '-q'])
+    _batch_check_call(['systemctl', 'reload', 'nginx'] if os.path.isdir('/run/systemd/system') else ['service', 'nginx', 'reload'])
+
+
+def _nginx_restore(files, links):
+    """ Put the nginx configuration back as it was before it was rewritten
+        :param files: dict {path: previous content, or None to remove the file}
+        :param links: dict {path: previous target of the symlink, or None to remove the symlink}
+    """
+    for link, target in links.items():
+        if os.path.lexists(link):
+            os.unlink(link)
+        if target:
+            os.symlink(target, link)
+    for path, content in files.items():
+        if content is None:
+            if os.path.lexists(path):
+                os.unlink(path)
+        else:
+            _write_if_changed(path, content)
+
+
+def odoo_active_instance(version):
+    """ Instance of a version nginx sends the requests to, read from the upstream file of the version
+        :returns the instance number (0 if the file does not exist yet)
+    """
+    try:
+        with open(NGINX_UPSTREAM_PATH % (version,)) as f:
+            match = re.search(r'instance (\d+)', f.readline())
+    except IOError:
+        return 0
+    return int(match.group(1)) if match else 0
+
+
+def odoo_write_upstream(version, instance=None, backup=None):
+    """ Write the nginx upstreams of a version, pointing to the ports of the given instance (by
+        default the active one). nginx is not reloaded: until then, the previous instance keeps
+        serving the requests.
+        :param backup: optional dict filled with the previous content of the file (see `_write_if_changed`)
+        :returns tuple (path of the upstream file, whether it changed)
+    """
+    if instance is None:
+        instance = odoo_active_instance(version)
+    ports = dict((r['purpose'], r['port']) for r in odoo_list_ports(version) if r['instance'] == instance)
+    if ODOO_PORT_HTTP not in ports or ODOO_PORT_LONGPOLLING not in ports:
+        raise RuntimeError('No ports reserved for instance %s of %s' % (instance, version))
+    with open(NGINX_UPSTREAM_TEMPLATE) as f:
+        template = f.read()
+    path = NGINX_UPSTREAM_PATH % (version,)
+    changed = _write_if_changed(path, template % {'version': version, 'instance': instance,
+                                                  'port': ports[ODOO_PORT_HTTP], 'longpolling_port': ports[ODOO_PORT_LONGPOLLING]},
+                                backup=backup)
+    return path, changed
+
+
+def odoo_switch_instance(version, instance):
+    """ Send the requests of a version to the given instance: the upstreams are rewritten, then nginx
+        is gracefully reloaded (its old workers finish the running requests), if they changed
+        :returns the path of the upstream file
+    """
+    previous = odoo_active_instance(version)
+    path, changed = odoo_write_upstream(version, instance)
+    if not changed:
+        return path
+    try:
+        _nginx_reload()
+    except RuntimeError:
+        odoo_write_upstream(version, previous)
+        raise
+    return path
+
+
+def batch_nginx(jobs=BATCH_JOBS):
+    """ Regenerate the upstreams of every odoo version and the nginx site of every odoo database,
+        leaving untouched the files whose content is unchanged. Then, if a file changed and all the
+        sites were written, check the configuration and reload nginx once. If a site can not be
+        written, the files are restored (the new ones removed); if the check or the reload fails,
+        they are restored too and the error is raised.
+        :returns the batch report, the message of the unchanged sites is 'unchanged'
+    """
+    with cursor(commit=False) as cr:
+        cr.execute(_ODOO_DB_INFO_QUERY + """
+            WHERE D.db_type = 'postgres' AND A.service_type = 'odoo'
+            ORDER BY D.name
+        """)
+        databases = [(d.dbname, d._asdict()) for d in cr.fetchall()]
+    with open(NGINX_TEMPLATE) as f:
+        template = f.read()
+
+    files, links = {}, {}
+
+    def _write_site(dbinfo):
+        if not dbinfo['port']:
+            raise RuntimeError('no port for version %s' % (dbinfo['version'],))
+        values = dict(dbinfo, url=dbinfo['service_name'], longpollingport=dbinfo['longpolling_port'])
+        path = os.path.join(NGINX_SITES_AVAILABLE, dbinfo['dbname'])
+        changed = _write_if_changed(path, template % values, backup=files)
+        link = os.path.join(NGINX_SITES_ENABLED, dbinfo['dbname'])
+        if os.path.realpath(link) != path:
+            if os.path.islink(link):
+                links.setdefault(link, os.readlink(link))
+            elif os.path.lexists(link):
+                with open(link) as f:
+                    files.setdefault(link, f.read())
+            else:
+                links.setdefault(link, None)
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(path, link)
+            changed = True
+        return '' if changed else 'unchanged'
+
+    changed = False
+    for version in sorted(set(dbinfo['version'] for dbname, dbinfo in databases)):
+        changed = odoo_write_upstream(version, backup=files)[1] or changed
+    report = batch_run('nginx', databases, _write_site, jobs=jobs)
+    if any(r['result'] != 'ok' for r in report):
+        _logger.warning('nginx not reloaded: some sites were not written, restoring %s files', len(files) + len(links))
+        _nginx_restore(files, links)
+        return report
+    if changed or any(r['message'] != 'unchanged' for r in report):
+        try:
+            _nginx_reload()
+        except RuntimeError:
+            _logger.warning('nginx not reloaded, restoring %s files', len(files) + len(links))
+            _nginx_restore(files, links)
+            raise
+    return report
+
+
+def batch_restart(jobs=BATCH_JOBS):
+    """ Restart the service of the active instance of every odoo version
+        :returns the batch report
+    """
+    def _restart(version):
+        instance = odoo_active_instance(version)
+        service = 'openerp-%s-%s' % (version, instance) if instance else 'openerp-%s' % (version,)
+        if os.path.isfile('/etc/systemd/system/%s.service' % (service,)):
+            return _batch_check_call(['systemctl', 'restart', service])
+        if os.path.isfile('/etc/init.d/%s' % (service,)):
+            return _batch_check_call(['/etc/init.d/%s' % (service,), 'restart'])
+        raise RuntimeError('service %s not found' % (service,))
+
+    return batch_run('restart', [(version, version) for version in odoo_list_branches()], _restart, jobs=jobs)
+
+
+def batch_vacuum(jobs=BATCH_JOBS):
+    """ VACUUM ANALYZE every postgres tenant database
+        :returns the batch report
+    """
+    import psycopg2
+    with cursor(commit=False) as cr:
+        cr.execute("SELECT name FROM database WHERE db_type = 'postgres' ORDER BY name")
+        dbnames = [d.name for d in cr.fetchall()]
+
+    def _vacuum(dbname):
+        cnx = psycopg2.connect('dbname=%s' % (dbname,))
+        try:
+            cnx.autocommit = True
+            cnx.cursor().execute("VACUUM ANALYZE")
+        finally:
+            cnx.close()
+
+    return batch_run('vacuum', [(dbname, dbname) for dbname in dbnames], _vacuum, jobs=jobs)
+
+
+# ----------------------------------------------------------------------------
+# Daemon (serve lookups over a unix socket)
+# ----------------------------------------------------------------------------
+
+def meta_serve(socket_path=META_SOCKET):
+    """ Run the long-living meta daemon: keep a warm connection pool and answer the cloud-meta
+        commands sent on the given unix socket. Each request is a single JSON line `{"argv": [...]}`
+        and the answer is a JSON line `{"code": <int>, "output": <string>}`.
+        :param socket_path: absolute path of the unix socket to listen on
+    """
+    import SocketServer
+
+    class MetaRequestHandler(SocketServer.StreamRequestHandler):
+
+        def handle(self):
+            response = _serve_request(self.rfile.readline())
+            self.wfile.write(json.dumps(response) + '\n')
+
+    class MetaServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    # warm up the connection pool before accepting requests
+    with cursor(commit=False) as cr:
+        cr.execute("SELECT 1")
+
+    # keep the snapshot in sync with the writes of the daemon and the changes made outside of it
+    def _snapshot_keeper():
+        while True:
+            _snapshot_outdated.clear()
+            try:
+                snapshot_refresh()
+            except Exception:
+                _logger.exception('Error while refreshing the snapshot')
+            try:
+                metrics_flush()
+            except Exception:
+                _logger.exception('Error while writing the metrics')
+            _snapshot_outdated.wait(SNAPSHOT_CHECK_INTERVAL)
+
+    keeper = threading.Thread(target=_snapshot_keeper, name='snapshot-keeper')
+    keeper.daemon = True
+    keeper.start()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    old_umask = os.umask(0o077)  # only root can talk to the daemon
+    try:
+        server = MetaServer(socket_path, MetaRequestHandler)
+    finally:
+        os.umask(old_umask)
+
+    _logger.info('Serving meta lookups on %s', socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        metrics_flush()
+        _logger.info('Stop serving meta lookups on %s', socket_path)
+
+
+def _serve_request(line):
+    """ Execute the command received by the daemon and return the response values """
+    from docopt import docopt, DocoptExit
+    try:
+        argv = json.loads(line).get('argv', [])
+        opt = docopt(main.__doc__, argv=argv, help=False)
+        if opt['serve']:
+            return {'code': 2, 'output': 'serve can not be forwarded to the daemon'}
+        return {'code': 0, 'output': _execute(opt, mode='daemon')}
+    except (DocoptExit, ValueError) as e:
+        return {'code': 2, 'output': '%s' % (e,)}
+    except Exception as e:
+        _logger.exception('Error while serving %r', line)
+        return {'code': 1, 'output': '%s' % (e,)}
+
+
+def _client_call(argv, socket_path=META_SOCKET, write=False):
+    """ Forward the command to the meta daemon.
+        :param argv: command line arguments (without the program name)
+        :param write: whether the command writes: once sent, the daemon may have applied it, so it
+            is never run again in direct mode
+        :returns tuple (code, output) or None when the daemon is not reachable, or does not answer
+            properly (timeout, empty or truncated response) to a read command: the command then
+            runs in direct mode
+    """
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(META_SOCKET_TIMEOUT)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    try:
+        sock.sendall(json.dumps({'argv': argv}) + '\n')
+        response = json.loads(sock.makefile('r').readline())
+        return response['code'], response['output']
+    except (socket.error, ValueError, KeyError, TypeError) as e:  # socket.timeout is a socket.error
+        if write:
+            _logger.error('No valid answer from the meta daemon (%s) to %s', e, ' '.join(argv))
+            return 1, 'No valid answer from the meta daemon (%s): %s may have been applied, check before running it again' % (e, ' '.join(argv))
+        _logger.warning('No valid answer from the meta daemon (%s), running %s directly', e, ' '.join(argv))
+        return None
+    finally:
+        sock.close()
+
+
+_WRITE_COMMANDS = ['lemp-add', 'odoo-add-version', 'odoo-add-instance', 'odoo-release-instance', 'odoo-reserve-port', 'odoo-add-database', 'import', 'migrate']
+_DIRECT_COMMANDS = ['import', 'export', 'migrate', 'odoo-active-instance', 'odoo-switch-instance', 'batch-nginx', 'batch-restart', 'batch-vacuum']  # commands using local files or std streams, never forwarded to the daemon
+
+
+def _command_name(opt):
+    return next((key for key, value in opt.items() if value is True and key[0] not in '-<'), None)
+
+
+def _execute(opt, mode='direct'):
+    """ Run the command described by the parsed docopt options and return its output as a string """
+    with instrument_command(_command_name(opt), mode):
+        output = _execute_command(opt)
+    if any(opt[command] for command in _WRITE_COMMANDS):
+        if mode == 'daemon':
+            # answer right away, the keeper rebuilds the snapshot (long on large meta databases)
+            _snapshot_outdated.set()
+            return output
+        try:
+            snapshot_refresh()
+        except Exception:
+            _logger.exception('Error while refreshing the snapshot')
+    return output
+
+
+def _execute_command(opt):
     # common
     if opt['info']:
-        print(account_info(opt['name']))
+        return account_info(opt['<name>'])
+    elif opt['list-accounts']:
+        columns = ['name', 'server_name', 'service_type', 'status', 'version', 'port', 'longpolling_port', 'databases']
+        text_fmt = lambda row: '%s (%s%s): %s' % (row['name'], row['service_type'], ' %s' % (row['version'],) if row['version'] else '', ' '.join(row['databases']))
+        return format_rows(account_list(), columns, opt['--format'], text_fmt=text_fmt)
     elif opt['lemp-add']:
-        print(lemp_add(opt['domain'], opt['unix_user'], opt['unix_group']))
+        return lemp_add(opt['<domain>'], opt['<unix_user>'], opt['<unix_group>'])
     # odoo
     elif opt['odoo-get-info']:
-        print(odoo_get_info(opt['<dbname>']))
+        return odoo_get_info(opt['<dbname>'])
     elif opt['odoo-list-branches']:
-        for branch in odoo_list_branches():
-            if opt['-p']:
-                print('%s (%d)' % (branch, odoo_get_port(branch)))
-            else:
-                print(branch)
+        if opt['-p'] or opt['--format'] != 'text':
+            columns = ['version', 'port', 'longpolling_port']
+            text_fmt = lambda row: '%s (%d)' % (row['version'], row['port'])
+            return format_rows(odoo_list_branches_info(), columns, opt['--format'], text_fmt=text_fmt)
+        return '\n'.join(odoo_list_branches())
     elif opt['odoo-last-branch']:
-        print(odoo_last_branch())
+        return odoo_last_branch()
     elif opt['odoo-get-port']:
-        print(odoo_get_port(opt['<branch>']))
+        return '%s' % (odoo_get_port(opt['<branch>']),)
     elif opt['odoo-get-longpolling-port']:
-        print(odoo_get_longpolling_port(opt['<branch>']))
+        return '%s' % (odoo_get_longpolling_port(opt['<branch>']),)
     elif opt['odoo-add-version']:
-        print(odoo_add_version(opt['<version>']))
+        return '%s' % (odoo_add_version(opt['<version>']),)
+    elif opt['odoo-add-instance']:
+        return json_dumps(odoo_add_instance(opt['<version>']))
+    elif opt['odoo-release-instance']:
+        return ' '.join('%s' % (port,) for port in odoo_release_instance(opt['<version>'], int(opt['<instance>'])))
+    elif opt['odoo-reserve-port']:
+        return '%s' % (odoo_reserve_port(opt['<version>'], opt['<purpose>'], int(opt['--instance'])),)
+    elif opt['odoo-list-ports']:
+        columns = ['version', 'instance', 'purpose', 'port']
+        text_fmt = lambda row: '%(version)s #%(instance)s %(purpose)s: %(port)s' % row
+        return format_rows(odoo_list_ports(opt['<version>']), columns, opt['--format'], text_fmt=text_fmt)
+    elif opt['odoo-active-instance']:
+        return '%s' % (odoo_active_instance(opt['<version>']),)
+    elif opt['odoo-switch-instance']:
+        version = opt['<version>']
+        return odoo_switch_instance(version, int(opt['<instance>']) if opt['<instance>'] else odoo_active_instance(version))
     elif opt['odoo-add-database']:
-        print(odoo_add_database(opt['<url>'], opt['<version>'], opt['<database>']))
+        return '%s' % (odoo_add_database(opt['<url>'], opt['<version>'], opt['<database>']),)
+    elif opt['import']:
+        columns = ['line', 'type', 'name', 'result', 'message']
+        text_fmt = lambda row: 'line %(line)s: %(type)s %(name)s %(result)s %(message)s' % row
+        return format_rows(meta_import(opt['<file>'], update=opt['--update']), columns, opt['--format'], text_fmt=text_fmt)
+    elif opt['export']:
+        if opt['<file>']:
+            with open(opt['<file>'], 'w') as stream:
+                meta_export(stream, batch_size=int(opt['--batch-size']))
+        else:
+            meta_export(sys.stdout, batch_size=int(opt['--batch-size']))
+        return ''
+    elif opt['migrate']:
+        return '\n'.join(meta_migrate())
+    elif opt['batch-nginx'] or opt['batch-restart'] or opt['batch-vacuum']:
+        batch = batch_nginx if opt['batch-nginx'] else batch_restart if opt['batch-restart'] else batch_vacuum
+        columns = ['key', 'result', 'duration', 'message']
+        text_fmt = lambda row: '%(key)s: %(result)s (%(duration)s ms) %(message)s' % row
+        report = batch(jobs=int(opt['--jobs']))
+        output = format_rows(report, columns, opt['--format'], text_fmt=text_fmt)
+        failed = [r for r in report if r['result'] != 'ok']
+        if failed:
+            raise BatchError('%d of %d items failed or skipped' % (len(failed), len(report)), output)
+        return output
+    elif opt['snapshot-refresh']:
+        return '%s' % (snapshot_refresh(force=opt['--force']),)
+    return ''
+
+
+def _print_output(output):
+    if output:
+        print(output)
+
+
+def _startup_report():
+    """ Print on stderr the import time breakdown and the time spent since the start of the module """
+    total = (time.time() - _STARTUP_TIME) * 1000
+    lines = ['startup profile (ms):']
+    for depth, name, duration in _STARTUP_IMPORTS:
+        if depth <= 1 and duration >= 0.0001:  # skip already loaded relative imports
+            lines.append('  %-40s %8.2f' % ('  ' * depth + 'import ' + name, duration * 1000))
+    exceeded = ', EXCEEDED' if total > STARTUP_BUDGET_MS else ''
+    lines.append('  %-40s %8.2f (budget %d ms%s)' % ('total', total, STARTUP_BUDGET_MS, exceeded))
+    sys.stderr.write('\n'.join(lines) + '\n')
+
+
+def main():
+    """
+        Usage:
+            cloud-meta serve [options]
+            cloud-meta migrate [options]
+            cloud-meta snapshot-refresh [--force] [options]
+            cloud-meta import <file> [--update] [options]
+            cloud-meta export [<file>] [--batch-size=<n>] [options]
+            cloud-meta batch-nginx [--jobs=<n>] [options]
+            cloud-meta batch-restart [--jobs=<n>] [options]
+            cloud-meta batch-vacuum [--jobs=<n>] [options]
+            cloud-meta info <name> [options]
+            cloud-meta list-accounts [options]
+            cloud-meta lemp-add <domain> <unix_user> <unix_group> [options]
+            cloud-meta odoo-get-info <dbname> [options]
+            cloud-meta odoo-get-port <branch> [options]
+            cloud-meta odoo-get-longpolling-port <branch> [options]
+            cloud-meta odoo-list-branches [-a] [-p] [options]
+            cloud-meta odoo-last-branch [-a] [options]
+            cloud-meta odoo-add-version <version> [options]
+            cloud-meta odoo-add-instance <version> [options]
+            cloud-meta odoo-release-instance <version> <instance> [options]
+            cloud-meta odoo-reserve-port <version> <purpose> [--instance=<n>] [options]
+            cloud-meta odoo-list-ports [<version>] [options]
+            cloud-meta odoo-active-instance <version> [options]
+            cloud-meta odoo-switch-instance <version> [<instance>] [options]
+            cloud-meta odoo-add-database <url> <version> [-d <database>] [options]
+
+        Options:
+            --direct            Do not forward the command to the meta daemon, query the database directly
+            --fresh             Do not answer read commands from the local snapshot
+            --socket=<path>     Unix socket of the meta daemon [default: /var/run/cloud-meta.sock]
+            --format=<fmt>      Output format of list commands: text, json or tsv [default: text]
+            --batch-size=<n>    Number of rows fetched at once by the export [default: 2000]
+            --instance=<n>      Instance of the version the port is reserved for [default: 0]
+            --jobs=<n>          Number of concurrent workers of the batch commands [default: 4]
+            --profile-startup   Print the import time breakdown of the command on stderr
+    """
+    from docopt import docopt
+    import signal
+
+    if os.getuid() != 0:  # TODO: this might not be a good practice
+        sys.exit("cloud-meta must be run as root")
+
+    opt = docopt(main.__doc__)
+
+    if opt['--profile-startup']:
+        import atexit
+        atexit.register(_startup_report)
+
+    if opt['serve']:
+        signal.signal(signal.SIGTERM, lambda s, f: sys.exit(0))
+        meta_serve(opt['--socket'])
+        return
+
+    signal.signal(signal.SIGINT, _sigint_handler)
+
+    try:
+        _main_dispatch(opt)
+    finally:
+        try:
+            metrics_spool()
+        except Exception:
+            _logger.exception('Error while writing the metrics')
+
+
+def _main_dispatch(opt):
+    command = _command_name(opt)
+
+    # read commands are answered from the local snapshot, without any connection
+    expired = False
+    if not opt['--fresh']:
+        start = time.time()
+        expired = snapshot_expired()
+        output = snapshot_lookup(opt)
+        if output is not None:
+            command_done(command, 'snapshot', time.time() - start)
+            _print_output(output)
+            return
+
+    # thin client: let the daemon answer, fallback on direct mode when it is down
+    if not opt['--direct'] and not any(opt[name] for name in _DIRECT_COMMANDS):
+        start = time.time()
+        result = _client_call(sys.argv[1:], opt['--socket'], write=any(opt[name] for name in _WRITE_COMMANDS))
+        if result is not None:
+            code, output = result
+            command_done(command, 'client', time.time() - start, ok=not code)
+            if code:
+                sys.exit(output)
+            _print_output(output)
+            return
+
+    try:
+        _print_output(_execute(opt))
+    except BatchError as e:
+        _print_output(e.output)
+        sys.exit('%s' % (e,))
+
+    # without the daemon, the reads check the snapshot once it expired (after answering)
+    if expired and not any(opt[name] for name in _WRITE_COMMANDS):
+        try:
+            snapshot_refresh()
+        except Exception:
+            _logger.exception('Error while refreshing the snapshot')
 
 if __name__ == '__main__':
     main()
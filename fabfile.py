@@ -11,16 +11,24 @@
 #
 """
 import ConfigParser
+import contextlib
+import datetime
+import hashlib
+import inspect
 import io
 import json
 import os
 import re
+import sys
+import time
+import traceback
 
-from fabric.api import task, env, run, cd, sudo, put, hide, hosts, local, get, execute
+from fabric.api import task, env, run, cd, sudo, put, hide, hosts, local, get, execute, runs_once
 from fabric.colors import red, yellow, green, blue, white
 from fabric.utils import abort, puts, fastprint, warn
-from fabric.context_managers import warn_only, settings, shell_env
+from fabric.context_managers import warn_only, settings
 from fabric.contrib.files import exists, upload_template
+from fabric.contrib.project import rsync_project
 
 import fabtools
 import fabtools.require
@@ -38,6 +46,15 @@ SERV_DIR_RESOURCES = '/root/cloud/setup/resources'
 SERV_DIR_FILES = '/root/cloud/setup/cloud_files'
 CONFIG = {}
 
+DEPLOY_POOL_SIZE = 8
+DEPLOY_LOG_DIR = os.path.join(HERE, 'log', 'deploy')
+DEPLOY_STATE_FILE = '/root/cloud/deploy-state.json'  # fingerprints of the deployed steps
+PACKAGE_CACHE_LOCAL_DIR = os.path.join(HERE, 'log', 'package-cache')  # <codename>/{debs,pip,pip3,manifest.json}
+PACKAGE_CACHE_REMOTE_DIR = '/var/cache/cloud-packages'
+NGINX_NOFILE = 16384  # open files limit of the nginx workers, as the LimitNOFILE of the odoo services
+NGINX_CACHE_DIR = '/var/cache/nginx/odoo'
+NGINX_CACHE_LOG = '/var/log/nginx/odoo-cache.log'
+
 ODOO_USER = os.environ.get('ODOO_USER', 'odoo')
 if not re.match(r'^[a-z_]+$', ODOO_USER):
     abort('%r is not alphabetical' % (ODOO_USER,))
@@ -45,6 +62,13 @@ if not re.match(r'^[a-z_]+$', ODOO_USER):
 ODOO_DIR_HOME = '/home/%s' % ODOO_USER
 ODOO_DIR_SRC = ODOO_DIR_HOME + '/src'
 ODOO_DEFAULT_VERSION = '11.0'
+# shallow (number of commits) and partial (e.g. 'blob:none') fetch of the odoo sources
+ODOO_GIT_DEPTH = os.environ.get('ODOO_GIT_DEPTH')
+ODOO_GIT_FILTER = os.environ.get('ODOO_GIT_FILTER')
+ODOO_FETCH_JOBS = 4  # concurrent git commands when fetching the sources
+ODOO_BLUEGREEN_INSTANCES = (0, 1)  # instances of a series taking turns to serve its requests
+ODOO_HEALTH_TIMEOUT = 120  # seconds given to a new instance to answer, and to each database to load
+ODOO_DRAIN_DELAY = 60  # seconds the old instance keeps running after the switch (longpolling lasts 50s)
 # those github repo should be versionned as the odoo community repo (same branch nickname)
 ODOO_REPO_DIR_MAP = {
     'odoo': 'https://github.com/odoo/odoo.git',
@@ -68,10 +92,82 @@ def as_(user):
                 return fun(*args, **kwargs)
             finally:
                 env.user = current_user
+        wrapper.__wrapped__ = fun
         return wrapper
     return deco
 
 
+class RemoteBatch(object):
+    """ Shell commands collected to be run on the host as a single remote script (one SSH channel
+        instead of one per command). The commands run in order in the same shell and the script
+        stops at the first failing one, as with `set -e`, but the exit code of each command is
+        reported so the failing command is known.
+    """
+    MARKER = '__fab_batch_rc__'
+
+    def __init__(self, use_sudo=True):
+        self.use_sudo = use_sudo
+        self.commands = []
+
+    def run(self, command):
+        self.commands.append(command)
+
+    sudo = run
+
+    def execute(self):
+        """ Run the collected commands. Aborts (or warns with warn_only) when a command fails.
+            :rtype list of tuple (command, exit code, output) of the commands that ran
+        """
+        if not self.commands:
+            return []
+        lines = []
+        for index, command in enumerate(self.commands):
+            lines.append(command)
+            # the marker starts a new line, even after an output without trailing newline
+            lines.append("rc=$?; printf '\\n%s %s %s\\n' {0} {1} $rc; [ $rc -eq 0 ] || exit $rc".format(self.MARKER, index))
+        runner = sudo if self.use_sudo else run
+        puts(blue('Running a batch of {0} commands'.format(len(self.commands))))
+        with hide('running', 'output', 'warnings'), settings(warn_only=True):
+            output = runner('\n'.join(lines))
+
+        results, buf = [], []
+        for line in output.splitlines():
+            if line.startswith(self.MARKER + ' '):
+                index, code = [int(value) for value in line.split()[1:3]]
+                if buf and not buf[-1]:  # the newline printed before the marker
+                    buf.pop()
+                results.append((self.commands[index], code, '\n'.join(buf)))
+                buf = []
+            else:
+                buf.append(line)
+        # the script stops at the first failure: the last reported command, or the next one if the
+        # shell died before reporting (e.g. `exit` in a command)
+        if results and results[-1][1]:
+            index = len(results) - 1
+            command, code, command_output = results[-1]
+        elif len(results) < len(self.commands):
+            index = len(results)
+            command, code, command_output = self.commands[index], output.return_code, '\n'.join(buf)
+        else:
+            return results
+        message = 'Batch command #{0} failed with exit code {1}: {2}\n{3}'.format(index, code, command, command_output)
+        if env.warn_only:
+            warn(message)
+        else:
+            abort(message)
+        return results
+
+
+@contextlib.contextmanager
+def remote_batch(use_sudo=True):
+    """ Collect the commands given to the yielded RemoteBatch (`batch.sudo(...)`, `batch.run(...)`)
+        and run them as one remote script at the end of the block.
+    """
+    batch = RemoteBatch(use_sudo=use_sudo)
+    yield batch
+    batch.execute()
+
+
 def _auto_load_config_file():
     config_values = {}
     file_path = "config.ini"
@@ -98,11 +194,97 @@ def _get_config(section_prefix):
     return result
 
 
+# ----------------------------------------------------------
+# Host Facts
+# ----------------------------------------------------------
+
+# one line `key=value` per fact, lists are space separated
+_HOST_FACTS_SCRIPT = r"""
+echo "systemd=$(command -v systemctl >/dev/null 2>&1 && echo 1)"
+echo "codename=$(lsb_release -cs 2>/dev/null)"
+echo "cpus=$(nproc 2>/dev/null)"
+echo "mem_kb=$(awk '/^MemTotal:/ {print $2}' /proc/meminfo)"
+echo "nofile_max=$(cat /proc/sys/fs/nr_open 2>/dev/null)"
+echo "cache_kb=$(df -Pk /var/cache 2>/dev/null | awk 'NR == 2 {print $4}')"
+echo "users=$(awk -F: '{printf "%s:%s:%s ", $1, $3, $4}' /etc/passwd)"
+echo "groups=$(cut -d: -f1 /etc/group | tr '\n' ' ')"
+echo "packages=$(dpkg-query -W -f '${db:Status-Abbrev}${Package}\n' 2>/dev/null | awk '$1 == "ii" {printf "%s ", $2}')"
+echo "running=$(systemctl list-units --type=service --state=running --no-legend --plain 2>/dev/null | awk '{sub(/\.service$/, "", $1); printf "%s ", $1}')"
+echo "processes=$(ps -eo comm= | sort -u | tr '\n' ' ')"
+echo "service_files=$(ls -d /etc/systemd/system/openerp-*.service /etc/init.d/openerp-* 2>/dev/null | tr '\n' ' ')"
+echo "pg_roles=$(cd / && sudo -u postgres psql -tAc 'SELECT usename FROM pg_user' 2>/dev/null | tr '\n' ' ')"
+"""
+
+_HOST_FACTS = {}  # {host string: facts}, for the current run
+
+
+def host_facts(refresh=False):
+    """ Facts of the current host (init system, distro, resources, users, packages, services and
+        postgres roles), gathered with a single remote command and cached for the run. Functions
+        changing the host are decorated by `mutates_host`, so the facts are gathered again after.
+        :rtype dict
+    """
+    host = env.host_string
+    if refresh or host not in _HOST_FACTS:
+        with hide('output', 'running', 'warnings'), settings(warn_only=True):
+            output = sudo(_HOST_FACTS_SCRIPT)
+        raw = dict(line.strip().partition('=')[::2] for line in output.splitlines() if '=' in line)
+        users = [user.split(':') for user in raw.get('users', '').split()]
+        _HOST_FACTS[host] = {
+            'systemd': raw.get('systemd') == '1',
+            'codename': raw.get('codename', ''),
+            'cpus': int(raw.get('cpus') or 1),
+            'mem_kb': int(raw.get('mem_kb') or 0),
+            'nofile_max': int(raw.get('nofile_max') or 1048576),  # highest open files limit of a process
+            'cache_kb': int(raw.get('cache_kb') or 0),  # free space for the caches
+            'users': dict((name, (int(uid), int(gid))) for name, uid, gid in users),
+            'groups': set(raw.get('groups', '').split()),
+            'packages': set(raw.get('packages', '').split()),
+            'running': set(raw.get('running', '').split()),
+            'processes': set(raw.get('processes', '').split()),
+            'service_files': set(raw.get('service_files', '').split()),
+            'pg_roles': set(raw.get('pg_roles', '').split()),
+        }
+    return _HOST_FACTS[host]
+
+
+def host_facts_invalidate():
+    _HOST_FACTS.pop(env.host_string, None)
+
+
+def mutates_host(fun):
+    """ Decorator of the functions changing the host: its facts are gathered again on next use """
+    @wraps(fun)
+    def wrapper(*args, **kwargs):
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            host_facts_invalidate()
+    wrapper.__wrapped__ = fun
+    return wrapper
+
+
 def has_systemd():
-    with hide('output', 'running', 'warnings'):
-        with settings(warn_only=True):
-            res = run('command -v systemctl')
-            return res.return_code == 0
+    return host_facts()['systemd']
+
+
+def service_is_running(name):
+    facts = host_facts()
+    if facts['systemd']:
+        return name in facts['running']
+    return name in facts['processes']
+
+
+@mutates_host
+def nginx_reload():
+    """ Check the nginx configuration, then reload it gracefully: unlike a restart, the running
+        requests and the keepalive connections are not dropped. nginx is started if it is not running.
+    """
+    sudo('nginx -t -q')
+    if service_is_running('nginx'):
+        fabtools.service.reload('nginx')
+    else:
+        fabtools.service.start('nginx')
 
 
 def _validate_domain(domain):
@@ -128,11 +310,226 @@ def domain2database(domain):
 # checking the existance of a user will always return True as a warning
 # "/bin/bash: /root/.bash_profile: Permission denied\r\ncould not
 # change directory to "/root" is returned, and is evaluated to True.
-# This method patch it.
+# The roles are listed from / by the host facts instead.
 def pg_user_exists(name):
-    with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
-        res = fabtools.postgres._run_as_pg('''psql -t -A -c "SELECT count(*) FROM pg_user WHERE usename='%(name)s';"''' % locals())
-    return '1' in res
+    return name in host_facts()['pg_roles']
+
+# ----------------------------------------------------------
+# Packages
+# ----------------------------------------------------------
+
+# upgradable debs (from the local apt index), installed pip and pip3 packages as `name==version`
+# (pip 8 of xenial has no json output) and npm packages as json
+_PACKAGES_SCRIPT = r"""
+echo "upgradable=$(apt list --upgradable 2>/dev/null | awk -F/ 'NR > 1 {printf "%s ", $1}')"
+echo "pip=$(pip freeze --all 2>/dev/null | tr '\n' ' ')"
+echo "pip3=$(pip3 freeze --all 2>/dev/null | tr '\n' ' ')"
+echo "npm=$(npm ls -g --depth=0 --json 2>/dev/null | tr -d '\n')"
+"""
+
+
+def _pip_name(name):
+    return name.lower().replace('_', '-')
+
+
+def packages_state():
+    """ Installed packages of the host, for each manager, in one remote command (debs come from
+        the host facts)
+        :rtype dict {manager: {package name: version or None}}, and the set of upgradable debs
+    """
+    with hide('output', 'running', 'warnings'), settings(warn_only=True):
+        output = sudo(_PACKAGES_SCRIPT)
+    raw = dict(line.strip().partition('=')[::2] for line in output.splitlines() if '=' in line)
+
+    def _freeze(value):
+        specs = [spec.partition('==') for spec in (value or '').split()]
+        return dict((_pip_name(name), version) for name, sep, version in specs if sep)
+
+    def _json(value, default):
+        try:
+            return json.loads(value) if value else default
+        except ValueError:
+            return default
+
+    state = {
+        'deb': dict((name, None) for name in host_facts()['packages']),
+        'pip': _freeze(raw.get('pip')),
+        'pip3': _freeze(raw.get('pip3')),
+        'npm': dict((name, p.get('version')) for name, p in _json(raw.get('npm'), {}).get('dependencies', {}).items()),
+    }
+    upgradable = set(raw.get('upgradable', '').split())
+    return state, upgradable
+
+
+def packages_diff(wanted, state, upgradable=()):
+    """ Compute the packages to install for each manager
+        :param wanted: dict {manager: list of package specs}, pip specs can be pinned (`name==version`)
+        :param state: installed packages, as returned by `packages_state`
+        :param upgradable: debs with a newer version available
+        :rtype dict {manager: (missing specs, outdated specs)}
+    """
+    diff = {}
+    for manager, specs in wanted.items():
+        installed = state.get(manager, {})
+        missing, outdated = [], []
+        for spec in specs:
+            name, dummy, version = spec.partition('==')
+            name = _pip_name(name) if manager in ('pip', 'pip3') else name
+            if name not in installed:
+                missing.append(spec)
+            elif version and installed[name] != version:
+                outdated.append(spec)
+            elif manager == 'deb' and name in upgradable:
+                outdated.append(spec)
+        diff[manager] = (missing, outdated)
+    return diff
+
+
+_PACKAGES_INSTALL = {
+    'deb': 'DEBIAN_FRONTEND=noninteractive apt-get install -y -q --force-yes --ignore-missing {0}',
+    'pip': 'pip install -q {0}',
+    'pip3': 'pip3 install -q {0}',
+    'npm': 'npm install -g {0}',
+}
+
+# install from the package cache: debs are put in the apt archives (apt only downloads the ones
+# whose version differs from its index), pip packages are installed from the cached wheels only (the
+# packages that are not in the cache manifest are installed from the index, see `packages_sync`)
+_PACKAGES_CACHE_INSTALL = {
+    'deb': 'find {1}/debs -name "*.deb" -exec cp -n -t /var/cache/apt/archives/ {{}} + && ' + _PACKAGES_INSTALL['deb'],
+    'pip': 'pip install -q --no-index --find-links {1}/pip {0}',
+    'pip3': 'pip3 install -q --no-index --find-links {1}/pip3 {0}',
+}
+
+
+@mutates_host
+def packages_sync(wanted, purge_debs=(), cache_dir=None):
+    """ Install the missing and outdated packages only: one command per manager, all run in a single
+        remote batch. The apt index should be up to date to know the upgradable debs.
+        :param wanted: dict {manager: list of package specs} (managers: deb, pip, pip3, npm)
+        :param purge_debs: debs to remove if installed
+        :param cache_dir: remote directory of the package cache to install from (see `package_cache_push`)
+        :returns the diff that was applied (see `packages_diff`)
+    """
+    state, upgradable = packages_state()
+    diff = packages_diff(wanted, state, upgradable)
+    purge = [name for name in purge_debs if name in state['deb']]
+    cached_specs = _package_cache_packages() if cache_dir else {}
+    with remote_batch() as batch:
+        if purge:
+            batch.sudo('DEBIAN_FRONTEND=noninteractive apt-get purge -y -q {0}'.format(' '.join(purge)))
+        for manager in ['deb', 'pip', 'pip3', 'npm']:
+            specs = sum(diff.get(manager, ([], [])), [])
+            command = _PACKAGES_CACHE_INSTALL.get(manager) if cache_dir else None
+            if command and manager != 'deb':
+                # a stale cache lacks the packages added since it was built: those come from the index
+                cached = [spec for spec in specs if spec in cached_specs.get(manager, ())]
+                specs = [spec for spec in specs if spec not in cached]
+                if cached:
+                    batch.sudo(command.format(' '.join(cached), cache_dir))
+                command = None
+            if specs:
+                batch.sudo((command or _PACKAGES_INSTALL[manager]).format(' '.join(specs), cache_dir))
+
+    if purge:
+        puts(yellow('deb: removed {0}'.format(' '.join(purge))))
+    for manager in ['deb', 'pip', 'pip3', 'npm']:
+        missing, outdated = diff.get(manager, ([], []))
+        if missing:
+            puts(green('{0}: installed {1}'.format(manager, ' '.join(missing))))
+        if outdated:
+            puts(green('{0}: upgraded {1}'.format(manager, ' '.join(outdated))))
+        if manager in diff and not missing and not outdated:
+            puts(blue('{0}: {1} packages up to date'.format(manager, len(wanted[manager]))))
+    return diff
+
+
+def _package_cache_local(codename=None):
+    return os.path.join(PACKAGE_CACHE_LOCAL_DIR, codename or host_facts()['codename'])
+
+
+def _package_cache_manifest():
+    """ Content of the manifest of the package cache of the host codename (empty if no cache) """
+    path = os.path.join(_package_cache_local(), 'manifest.json')
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return [f.read()]
+
+
+def _package_cache_packages():
+    """ Package specs of the package cache of the host codename, from its manifest
+        :rtype dict {manager: list of package specs} (empty if no cache)
+    """
+    path = os.path.join(_package_cache_local(), 'manifest.json')
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get('packages', {})
+
+
+@task
+@runs_once
+@as_('root')
+def package_cache_build():
+    """ Build the package cache of the distro codename of the first host (-H): all the debs (with
+        their dependencies) and wheels of the common and odoo packages are downloaded on the host,
+        then brought back in log/package-cache/<codename>. Deployments of hosts with the same
+        codename then install from this cache instead of the mirrors.
+
+            fab -H root@1.1.1.1 package_cache_build
+    """
+    codename = host_facts()['codename']
+    _setup_odoo_apt_sources()
+    fabtools.deb.update_index()
+
+    common, odoo = _common_packages(), _odoo_packages()[0]
+    debs = sorted(set(common['deb'] + odoo['deb']))
+    build_dir = '/tmp/cloud-packages-build'
+    with remote_batch() as batch:
+        batch.sudo('rm -rf {0} && mkdir -p {0}/debs/partial {0}/pip {0}/pip3 && touch {0}/status'.format(build_dir))
+        # empty dpkg status: all the dependencies are downloaded, not only the ones missing on this host
+        batch.sudo('apt-get install -y -q --force-yes --ignore-missing --download-only -o Dir::State::status={0}/status -o Dir::Cache::archives={0}/debs {1}'.format(build_dir, ' '.join(debs)))
+        batch.sudo('pip download -q -d {0}/pip {1}'.format(build_dir, ' '.join(common['pip'])))
+        batch.sudo('pip3 download -q -d {0}/pip3 {1}'.format(build_dir, ' '.join(odoo['pip3'])))
+        batch.sudo('rm -rf {0}/debs/partial {0}/debs/lock {0}/status'.format(build_dir))
+        batch.sudo('tar -C {0} -czf {0}.tgz .'.format(build_dir))
+
+    local_dir = _package_cache_local(codename)
+    if os.path.isdir(local_dir):
+        local('rm -rf {0}'.format(local_dir))
+    os.makedirs(local_dir)
+    get(build_dir + '.tgz', local_dir + '.tgz')
+    local('tar -C {0} -xzf {0}.tgz && rm {0}.tgz'.format(local_dir))
+    sudo('rm -rf {0} {0}.tgz'.format(build_dir))
+
+    files = {}
+    for directory in ['debs', 'pip', 'pip3']:
+        files[directory] = sorted(os.listdir(os.path.join(local_dir, directory)))
+    manifest = {
+        'codename': codename,
+        'build_date': datetime.datetime.now().isoformat(),
+        'packages': {'deb': debs, 'pip': common['pip'], 'pip3': odoo['pip3']},
+        'files': files,
+    }
+    with open(os.path.join(local_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    puts(green('Package cache of {0}: {1} debs, {2} pip and {3} pip3 packages in {4}'.format(
+        codename, len(files['debs']), len(files['pip']), len(files['pip3']), local_dir)))
+
+
+def package_cache_push():
+    """ Upload the package cache of the host codename on the host, if such cache was built
+        :returns the remote directory of the cache, or None if there is no cache
+    """
+    local_dir = _package_cache_local()
+    if not os.path.isfile(os.path.join(local_dir, 'manifest.json')):
+        return None
+    remote_dir = '{0}/{1}'.format(PACKAGE_CACHE_REMOTE_DIR, host_facts()['codename'])
+    sudo('mkdir -p {0}'.format(remote_dir))
+    rsync_project(remote_dir=remote_dir + '/', local_dir=local_dir + '/', delete=True, extra_opts='-q')
+    return remote_dir
+
 
 # ----------------------------------------------------------
 # Git Utils
@@ -179,35 +576,200 @@ def git_update_directory(path):
 # Deployment / Setup for Odoo and LEMP server
 # ----------------------------------------------------------
 
-@task
-@as_('root')
-def deploy(server=False):
+def _remote_hashes(*paths):
+    """ git object hashes of the given paths of the setup repo checked out on the server """
+    with cd(SERV_DIR_CLOUD_SETUP), hide('output', 'running'):
+        return sudo('git rev-parse {0}'.format(' '.join('HEAD:%s' % (path,) for path in paths))).split()
+
+
+def _local_resource(name):
+    """ content of a file of the local resources, rendered on the hosts """
+    with open(os.path.join(LOCAL_DIR_RESOURCES, name)) as f:
+        return f.read()
+
+
+def _sources(*funcs):
+    """ source code of the given functions (not the one of their decorators) """
+    result = []
+    for func in funcs:
+        while hasattr(func, '__wrapped__'):
+            func = func.__wrapped__
+        result.append(inspect.getsource(func))
+    return result
+
+
+def _deploy_steps(server=False):
+    """ Ordered steps of the deployment of a host, with the inputs they depend on. The inputs are
+        evaluated just before the step (remote hashes are only valid once the scripts are updated).
+        A step without inputs always runs.
+        :param server: 'odoo' or 'lemp' to only deploy this kind of server, both otherwise
+        :rtype list of tuple (step name, function, inputs function or None)
+    """
+    steps = []
+    # all the installed debs are upgraded weekly, not only the ones listed below
+    week = lambda: [datetime.date.today().isocalendar()[:2]]
+    steps.append(('system_upgrade', _setup_system_upgrade, week))
+    # the package steps also run weekly, to get the upgrades of the listed packages
     if not server:
-        _setup_common_packages()
+        steps.append(('common_packages', _setup_common_packages, lambda: _sources(_setup_common_packages, _common_packages) + _package_cache_manifest() + week()))
 
-    _setup_server_scripts()
+    steps.append(('server_scripts', _setup_server_scripts, None))
 
     # Odoo Server Deploy
     if not server or server == 'odoo':
-        _setup_odoo_packages()
-        _setup_odoo_user()
-        run('geoipupdate')
+        steps.append(('odoo_packages', _setup_odoo_packages, lambda: _sources(_setup_odoo_packages, _odoo_packages, _setup_odoo_apt_sources) + _package_cache_manifest() + week()))
+        steps.append(('odoo_user', _setup_odoo_user, lambda: _sources(_setup_odoo_user) + [ODOO_USER]))
+        # the GeoIP databases are updated weekly
+        steps.append(('geoipupdate', lambda: run('geoipupdate'), week))
     # LEMP Server Deploy
     if not server or server == 'lemp':
-        _setup_lemp_server()
+        steps.append(('lemp_server', _setup_lemp_server, lambda: _remote_hashes('cloud_tools', 'tmpl')))
 
-    _setup_rsync_files(server)
+    steps.append(('rsync_files', lambda: _setup_rsync_files(server), lambda: _sources(_setup_rsync_files) + _remote_hashes('cloud_files') + [server]))
+    steps.append(('nginx_conf', _setup_nginx_conf, lambda: _sources(_setup_nginx_conf, _nginx_conf_values, nginx_install_config) + [_nginx_conf_values(), _local_resource('nginx_conf.tpl')]))
+    if not server or server == 'odoo':
+        steps.append(('nginx_cache', _setup_nginx_cache, lambda: _sources(_setup_nginx_cache, _nginx_cache_sizes, nginx_install_config) + [_nginx_cache_sizes(), _local_resource('nginx_cache.tpl')]))
 
     if not server:
-        fabtools.require.service.stopped('postgresql')
-        _setup_postgres()
-        fabtools.require.service.restarted('postgresql')
+        def _postgres():
+            fabtools.require.service.stopped('postgresql')
+            _setup_postgres()
+            fabtools.require.service.restarted('postgresql')
+        steps.append(('postgres', _postgres, lambda: _sources(_postgres, _setup_postgres) + _remote_hashes('cloud_files/etc/postgresql')))
 
-    setup_metabase()
+    steps.append(('metabase', setup_metabase, lambda: _remote_hashes('resources/migrations')))
+    steps.append(('meta_daemon', _setup_meta_daemon, lambda: _remote_hashes('cloud_meta.py', 'cloud_files/etc/systemd/system/cloud-meta.service')))
+    return steps
 
 
-def _setup_common_packages():
-    """ Method to install common packages """
+def _deploy_state_read():
+    """ Fingerprints of the steps of the last deployment of the host """
+    with hide('output', 'running', 'warnings'), settings(warn_only=True):
+        content = sudo('cat {0}'.format(DEPLOY_STATE_FILE))
+    try:
+        return json.loads(content) if content.succeeded else {}
+    except ValueError:
+        return {}
+
+
+def _deploy_state_write(state):
+    put(io.BytesIO(json.dumps(state, indent=2, sort_keys=True)), DEPLOY_STATE_FILE, use_sudo=True, mode=0o600)
+
+
+def _deploy_run_step(name, step, inputs, state, force=False):
+    """ Run the step if the fingerprint of its inputs changed since the last successful run, and
+        record its new fingerprint in the state file of the host.
+        :returns True if the step ran, False if it was unchanged
+    """
+    fingerprint = hashlib.sha1(json.dumps(inputs(), sort_keys=True)).hexdigest() if inputs else None
+    if fingerprint and not force and state.get(name) == fingerprint:
+        puts(green('Step {0} unchanged: skipped'.format(name)))
+        return False
+    step()
+    if fingerprint:
+        state[name] = fingerprint
+        _deploy_state_write(state)
+    return True
+
+
+def _as_bool(value):
+    """ fab task arguments are strings """
+    return value not in (False, None, '', '0', 'False', 'false', 'no')
+
+
+@task
+@as_('root')
+def deploy(server=False, force=False):
+    """ Deploy the host. Steps whose inputs (package lists, files of the setup repo, ...) did not
+        change since their last run are skipped, unless `force` is set.
+    """
+    state = {} if _as_bool(force) else _deploy_state_read()
+    for name, step, inputs in _deploy_steps(server):
+        _deploy_run_step(name, step, inputs, state, force=_as_bool(force))
+
+
+@task
+@runs_once
+def deploy_fleet(server=False, pool_size=DEPLOY_POOL_SIZE, log_dir=DEPLOY_LOG_DIR, force=False):
+    """ Deploy all the given hosts (-H) in parallel, at most `pool_size` at once. The output of each
+        host is written in `log_dir`/<host>.log instead of being interleaved, and a table of the
+        duration and status of each step of each host is printed at the end.
+
+            fab -H root@1.1.1.1,root@2.2.2.2 deploy_fleet:pool_size=10
+    """
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    start = time.time()
+    # a host failing or unreachable must not abort the others, it is reported in the table
+    with settings(parallel=True, pool_size=int(pool_size), warn_only=True, skip_bad_hosts=True):
+        results = execute(_deploy_host, server=server, log_dir=log_dir, force=force)
+
+    rows = []
+    for host in sorted(results):
+        report = results[host]
+        if not isinstance(report, list):  # the host process died
+            report = [{'step': 'deploy', 'status': 'crashed', 'duration': 0.0, 'message': '%s' % (report,)}]
+        rows += [(host, r['step'], r['status'], r['duration'], r['message']) for r in report]
+        total = sum(r['duration'] for r in report)
+        failed = any(r['status'] in ('failed', 'crashed') for r in report)
+        rows.append((host, 'TOTAL', 'failed' if failed else 'ok', total, ''))
+
+    puts('%-30s %-18s %-9s %9s  %s' % ('host', 'step', 'status', 'duration', 'message'))
+    for host, step, status, duration, message in rows:
+        color = red if status in ('failed', 'crashed') else green if step == 'TOTAL' else white
+        puts(color('%-30s %-18s %-9s %8.1fs  %s' % (host, step, status, duration, message)))
+    failed_hosts = sorted(host for host, step, status, duration, message in rows if step == 'TOTAL' and status != 'ok')
+    puts(blue('%d host(s) deployed in %.1fs, %d failed %s' % (len(results), time.time() - start, len(failed_hosts), ' '.join(failed_hosts))))
+    puts(blue('Logs of each host in %s' % (log_dir,)))
+    return results
+
+
+@as_('root')
+def _deploy_host(server=False, log_dir=DEPLOY_LOG_DIR, force=False):
+    """ Run the deployment steps on the current host, with its output written in its own log file.
+        The deployment of the host stops at the first failed step; the next ones are skipped.
+        :rtype list of dict with step, status ('ok', 'unchanged', 'failed' or 'skipped'), duration
+            and message
+    """
+    report = []
+    log_path = os.path.join(log_dir, '%s.log' % (env.host_string.replace('/', '_'),))
+    stdout, stderr = sys.stdout, sys.stderr
+    # warn_only is only set for deploy_fleet to collect the failed hosts: the steps abort on errors
+    with open(log_path, 'w') as log_file, settings(warn_only=False):
+        sys.stdout = sys.stderr = log_file
+
+        def _failed(e):
+            traceback.print_exc(file=log_file)
+            return 'failed', ('%s' % (e,)).strip().split('\n')[-1][:80]
+
+        try:
+            # the first remote call: an unreachable host is reported as failing this step
+            start = time.time()
+            state = {}
+            try:
+                state = {} if _as_bool(force) else _deploy_state_read()
+            except (Exception, SystemExit) as e:  # abort() raises SystemExit
+                status, message = _failed(e)
+                report.append({'step': 'state', 'status': status, 'duration': time.time() - start, 'message': message})
+            for name, step, inputs in _deploy_steps(server):
+                if report and report[-1]['status'] in ('failed', 'skipped'):
+                    report.append({'step': name, 'status': 'skipped', 'duration': 0.0, 'message': ''})
+                    continue
+                start = time.time()
+                try:
+                    ran = _deploy_run_step(name, step, inputs, state, force=_as_bool(force))
+                    status, message = 'ok' if ran else 'unchanged', ''
+                except (Exception, SystemExit) as e:
+                    status, message = _failed(e)
+                report.append({'step': name, 'status': status, 'duration': time.time() - start, 'message': message})
+                log_file.flush()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+    return report
+
+
+def _common_packages():
+    """ Packages of every server, by package manager """
     debs = """
 debconf-utils
 git
@@ -220,10 +782,6 @@ postgresql-contrib
 rsync
 vim
 """.split()
-    fabtools.deb.update_index()
-    run("apt-get upgrade -y --force-yes")
-    fabtools.deb.install(debs, options=['--force-yes', '--ignore-missing'])
-
     python_pip = """
 docopt
 fabric
@@ -232,7 +790,22 @@ mako
 sh
 suds
 """.split()
-    fabtools.python.install(python_pip, upgrade=True)
+    return {'deb': debs, 'pip': python_pip}
+
+
+@mutates_host
+def _setup_system_upgrade():
+    """ Upgrade all the installed debs, the ones not managed by the package lists included """
+    fabtools.deb.update_index()
+    fabtools.deb.upgrade()
+
+
+@mutates_host
+def _setup_common_packages():
+    """ Method to install common packages """
+    cache_dir = package_cache_push()
+    fabtools.deb.update_index()
+    packages_sync(_common_packages(), cache_dir=cache_dir)
 
 
 def _setup_server_scripts():
@@ -248,24 +821,25 @@ def _setup_server_scripts():
 
 def _setup_rsync_files(server=False):
     """ Synchronize files from the setup repo to the real server configuration, in order to set services, ... as it should be. """
-    # nginx config
-    sudo('rsync -rtlE %s/etc/nginx/nginx.conf /etc/nginx/nginx.conf' % (SERV_DIR_CLOUD_FILES,))
-    # postgres config
-    sudo("find /etc/postgresql -name 'postgresql.local.conf' -type l -delete")
-    sudo("find /etc/postgresql -name 'main' -type d -exec touch '{}/postgresql.local.conf' ';' -exec chown postgres:postgres '{}/postgresql.local.conf' ';'")
-    sudo('rsync -rtlE %s/etc/postgresql /etc/postgresql' % (SERV_DIR_CLOUD_FILES,))
-    # make cloud meta tool executable
-    sudo("mkdir -p %s/log" % (SERV_DIR_CLOUD_SETUP,))
-    sudo("chmod 775 %s/cloud-meta" % (SERV_DIR_CLOUD_SETUP,))
+    with remote_batch() as batch:
+        # postgres config
+        batch.sudo("find /etc/postgresql -name 'postgresql.local.conf' -type l -delete")
+        batch.sudo("find /etc/postgresql -name 'main' -type d -exec touch '{}/postgresql.local.conf' ';' -exec chown postgres:postgres '{}/postgresql.local.conf' ';'")
+        batch.sudo('rsync -rtlE %s/etc/postgresql /etc/postgresql' % (SERV_DIR_CLOUD_FILES,))
+        # make cloud meta tool executable
+        batch.sudo("mkdir -p %s/log" % (SERV_DIR_CLOUD_SETUP,))
+        batch.sudo("chmod 775 %s/cloud-meta" % (SERV_DIR_CLOUD_SETUP,))
+        batch.sudo('rsync -rtlE %s/etc/systemd/system/cloud-meta.service /etc/systemd/system/cloud-meta.service' % (SERV_DIR_CLOUD_FILES,))
+        batch.sudo('rsync -rtlE %s/etc/logrotate.d/cloud-meta /etc/logrotate.d/cloud-meta' % (SERV_DIR_CLOUD_FILES,))
 
-    if not server or server == 'odoo':
-        run('rsync -rtlE %s/odoo/ %s' % (SERV_DIR_CLOUD_FILES, ODOO_DIR_HOME))
-        sudo("chown -R {0}:{0} {1}/bin".format(ODOO_USER, ODOO_DIR_HOME))
+        if not server or server == 'odoo':
+            batch.run('rsync -rtlEog --chown={0}:{0} {1}/odoo/ {2}'.format(ODOO_USER, SERV_DIR_CLOUD_FILES, ODOO_DIR_HOME))
 
-        run('rsync -rtlE %s/etc/sudoers.d/ /etc/sudoers.d/' % (SERV_DIR_CLOUD_FILES,))
-        run('chmod 440 /etc/sudoers.d/*')
+            batch.run('rsync -rtlE %s/etc/sudoers.d/ /etc/sudoers.d/' % (SERV_DIR_CLOUD_FILES,))
+            batch.run('chmod 440 /etc/sudoers.d/*')
 
 
+@mutates_host
 def _setup_postgres(version='9.5'):
     """ Setup postgres databse user and root and odoo roles """
     datadir = '/home/postgres/%s/main' % version
@@ -285,29 +859,34 @@ def _setup_postgres(version='9.5'):
 @task
 @as_('root')
 def setup_metabase():
-    """ Create or update schema of `meta` database. Only root should access it since this is the cloud user. """
+    """ Create or migrate schema of `meta` database. Only root should access it since this is the cloud user. """
     META = 'meta'
     with settings(sudo_user=env.user):
         if not fabtools.postgres.database_exists(META):
             fabtools.postgres.create_database(META, owner='root')
 
-    with shell_env(PGOPTIONS='--client-min-messages=warning'):
-        sudo('psql -Xq -d {0} -f {1}/metabase.sql'.format(META, SERV_DIR_RESOURCES))
+    # apply only the migrations (resources/migrations) not applied yet
+    sudo('{0}/cloud-meta migrate --direct'.format(SERV_DIR_CLOUD_SETUP))
 
 
 @as_('root')
-def _setup_odoo_packages():
-    """ Install/Update debian and python packages needed for Odoo Server """
-    codename = sudo('lsb_release -cs').strip()
-    uninstall = """mlocate xinetd locate wkhtmltopdf whoopsie""".split()
-    # local packages repo
-    sio = io.BytesIO(b"deb http://nightly.openerp.com/deb/%s ./" % codename)
-    put(sio, '/etc/apt/sources.list.d/odoo.list')
+def _setup_meta_daemon():
+    """ (Re)start the cloud-meta daemon answering meta lookups on its unix socket. The CLI falls back
+        on direct database queries when the daemon is not running (e.g. on SysV init hosts).
+    """
+    if not has_systemd():
+        puts(yellow('systemd not available: cloud-meta daemon not installed'))
+        return
+    run('systemctl daemon-reload')
+    fabtools.systemd.enable('cloud-meta')
+    fabtools.systemd.restart('cloud-meta')
 
-    sio = io.BytesIO(b"Package: nginx\nPin: origin nightly.openerp.com\nPin-Priority: 1001")
-    put(sio, '/etc/apt/preferences.d/odoo')
 
-    run('add-apt-repository -y ppa:maxmind/ppa')    # for geoipupdate
+def _odoo_packages():
+    """ Packages of the odoo servers, by package manager, and the debs to remove
+        :rtype tuple (dict {manager: list of package specs}, list of debs)
+    """
+    uninstall = """mlocate xinetd locate wkhtmltopdf whoopsie""".split()
 
     base_debs = """
 curl
@@ -347,9 +926,6 @@ vim
 wkhtmltox
 zip
 """.split()
-    fabtools.deb.uninstall(uninstall, purge=True, options=['--quiet'])
-    fabtools.deb.update_index()
-    run("apt-get upgrade -y --force-yes")
 
     p3_debs = """
         python3-dev
@@ -403,47 +979,145 @@ zip
         xlwt
     """.split()
 
-    debs = base_debs + p3_debs
-    fabtools.deb.install(debs, options=['--force-yes', '--ignore-missing'])
-
     # NOTE libevent-dev is required by gevent. /!\ version 1.0 of gevent will require libev-dev (and cython)
     # run('pip install cython -e git://github.com/surfly/gevent.git@1.0rc2#egg=gevent')
 
-    # fabtools.python.install(python_pip, upgrade=False)
-    run("pip3 install -q {}".format(' '.join(p3_pips)))
+    return {
+        'deb': base_debs + p3_debs,
+        'pip3': p3_pips,
+        'npm': ['less', 'less-plugin-clean-css'],
+    }, uninstall
 
-    # Nodejs
+
+def _setup_odoo_apt_sources():
+    """ apt sources of the odoo packages (nginx, wkhtmltox and geoipupdate) """
+    codename = host_facts()['codename']
+    # local packages repo
+    sio = io.BytesIO(b"deb http://nightly.openerp.com/deb/%s ./" % codename)
+    put(sio, '/etc/apt/sources.list.d/odoo.list')
+
+    sio = io.BytesIO(b"Package: nginx\nPin: origin nightly.openerp.com\nPin-Priority: 1001")
+    put(sio, '/etc/apt/preferences.d/odoo')
+
+    run('add-apt-repository -y ppa:maxmind/ppa')    # for geoipupdate
+
+
+@as_('root')
+@mutates_host
+def _setup_odoo_packages():
+    """ Install/Update debian and python packages needed for Odoo Server """
+    _setup_odoo_apt_sources()
+    cache_dir = package_cache_push()
+
+    # Nodejs (the link is valid once the debs are installed, before the npm packages)
     run("ln -sf /usr/bin/nodejs /usr/bin/node")
-    run("npm install -g less less-plugin-clean-css")
+
+    wanted, uninstall = _odoo_packages()
+    fabtools.deb.update_index()
+    packages_sync(wanted, purge_debs=uninstall, cache_dir=cache_dir)
 
 
+@mutates_host
 def _setup_odoo_user():
-    if not fabtools.user.exists(ODOO_USER):
+    if ODOO_USER not in host_facts()['users']:
         if ODOO_USER != 'odoo':
             abort('user %r does not exists' % ODOO_USER)
             return
         fabtools.user.create('odoo', create_home=True, shell='/bin/bash')
-    sudo('mkdir -p {0}/log'.format(ODOO_DIR_HOME))
-    sudo('mkdir -p {0}/src'.format(ODOO_DIR_HOME))
-    sudo('mkdir -p {0}/bin'.format(ODOO_DIR_HOME))
-
-    sudo("chown -R {0}:{0} {1}/log".format(ODOO_USER, ODOO_DIR_HOME))
-    sudo("chown -R {0}:{0} {1}/src".format(ODOO_USER, ODOO_DIR_HOME))
-    sudo("chown -R {0}:{0} {1}/bin".format(ODOO_USER, ODOO_DIR_HOME))
+    # only the directories themselves: their content is written by the odoo user (sources, logs)
+    # or synced with the right owner (bin)
+    sudo('install -d -o {0} -g {0} {1}/log {1}/src {1}/bin'.format(ODOO_USER, ODOO_DIR_HOME))
 
 
 @task
 def setup_odoo_services():  #TODO JEM: not sure this is usefull
     _setup_rsync_files('odoo')
-    if not fabtools.systemd.is_running('nginx'):
+    if not service_is_running('nginx'):
         fabtools.systemd.start('nginx')
     fabtools.systemd.enable('nginx')
 
+# ----------------------------------------------------------
+# Nginx
+# ----------------------------------------------------------
+
+@mutates_host
+def nginx_install_config(template, target, ctx):
+    """ Render a local template of the resources into an nginx configuration file of the host, then
+        reload nginx. The previous file is restored if the configuration fails `nginx -t`.
+    """
+    upload_template(os.path.join(LOCAL_DIR_RESOURCES, template), target + '.new', ctx, backup=False, mode='0644', use_sudo=True)
+    sudo('if [ -e {0} ]; then cp -p {0} {0}.orig; fi; mv {0}.new {0}'.format(target))
+    with settings(warn_only=True):
+        result = sudo('nginx -t -q')
+    if result.failed:
+        sudo('if [ -e {0}.orig ]; then mv {0}.orig {0}; else rm {0}; fi'.format(target))
+        abort('{0} not installed, rejected by nginx: {1}'.format(target, result))
+    sudo('rm -f {0}.orig'.format(target))
+    nginx_reload()
+
+
+def _nginx_conf_values():
+    """ Values of the nginx.conf of the host: one worker per cpu. Each proxied connection uses two
+        descriptors (client and upstream), and a quarter of the open files limit is left to the
+        open file cache.
+    """
+    facts = host_facts()
+    nofile = min(NGINX_NOFILE, facts['nofile_max'])
+    open_file_cache = nofile // 4
+    return {
+        'worker_processes': max(facts['cpus'], 1),
+        'worker_rlimit_nofile': nofile,
+        'worker_connections': (nofile - open_file_cache) // 2,
+        'open_file_cache': open_file_cache,
+    }
+
+
+def _setup_nginx_conf():
+    nginx_install_config('nginx_conf.tpl', '/etc/nginx/nginx.conf', _nginx_conf_values())
+
+
+def _nginx_cache_sizes():
+    """ Size of the proxy cache of the odoo sites: 10% of the free space of /var/cache (between
+        256 MB and 10 GB), and 1 MB of keys (about 8000 files) per 256 MB of memory (between 10 and
+        100 MB).
+    """
+    facts = host_facts()
+    return {
+        'max_size_mb': min(max(facts['cache_kb'] // 10 // 1024, 256), 10240),
+        'keys_mb': min(max(facts['mem_kb'] // 1024 // 256, 10), 100),
+    }
+
+
+def _setup_nginx_cache():
+    sudo('install -d -o www-data -g www-data {0}'.format(NGINX_CACHE_DIR))
+    ctx = dict(_nginx_cache_sizes(), cache_dir=NGINX_CACHE_DIR)
+    nginx_install_config('nginx_cache.tpl', '/etc/nginx/conf.d/odoo-cache.conf', ctx)
+
+
+@task
+@as_('root')
+def nginx_cache_stats():
+    """ Nginx: hit ratio of the proxy cache of the odoo sites, per site, from the cache log """
+    with hide('output', 'running'), settings(warn_only=True):
+        output = sudo("awk '{{print $1, $2}}' {0} | sort | uniq -c".format(NGINX_CACHE_LOG))
+    stats = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0].isdigit():
+            stats.setdefault(parts[1], {})[parts[2]] = int(parts[0])
+    for host, counts in sorted(stats.items()):
+        total = sum(counts.values())
+        hits = counts.get('HIT', 0) + counts.get('STALE', 0) + counts.get('UPDATING', 0) + counts.get('REVALIDATED', 0)
+        details = ' '.join('%s=%s' % item for item in sorted(counts.items()))
+        puts('%-40s %5.1f%% of %d requests (%s)' % (host, 100.0 * hits / total, total, details))
+
+
 # ----------------------------------------------------------
 # LEMP server
 # ----------------------------------------------------------
 
 @as_('root')
+@mutates_host
 def _setup_lemp_server():
     with cd('/root/cloud/setup'):
         sudo('./cloud-setup lemp setup -v')
@@ -460,23 +1134,25 @@ def update_lemp_server():
 
 @task
 @as_('root')
+@mutates_host
 def lemp_create_account(domain, user, password):
     group = user
     home_dir = '/home/%s' % (user,)
 
     # create unix group
-    if not fabtools.group.exists(group):
+    if group not in host_facts()['groups']:
         fabtools.group.create(group)
 
     # create unix user
-    if not fabtools.user.exists(user):
+    if user not in host_facts()['users']:
         fabtools.user.create(user, group=group, home=home_dir, shell='/bin/bash')
+        host_facts_invalidate()
 
-    # create php fpm and nginx files, and restart services
+    # create php fpm and nginx files, and reload services
     with cd('/root/cloud/setup'):
         sudo('./cloud-setup lemp newsite -d {dns} -u {user} -g {group} -v'.format(dns=domain, user=user, group=user))
-    fabtools.service.restart('php7.0-fpm')
-    fabtools.service.restart('nginx')
+    fabtools.service.reload('php7.0-fpm')
+    nginx_reload()
 
     # create mysql user and database
     if not fabtools.mysql.user_exists(user):
@@ -486,8 +1162,7 @@ def lemp_create_account(domain, user, password):
         fabtools.mysql.create_database(user, owner=user)
 
     # FTP SQL entries
-    unix_group_id = fabtools.utils.run_as_root("id -g %s" % (user,))
-    unix_user_id = fabtools.utils.run_as_root("id -u %s" % (user,))
+    unix_user_id, unix_group_id = host_facts()['users'][user]
 
     query = """INSERT IGNORE INTO meta.ftpgroup (groupname, gid, members) VALUES ("%s", %s, "%s");""" % (user, unix_group_id, user)
     puts(fabtools.mysql.query(query))
@@ -507,38 +1182,143 @@ def odoo_checkout(branch_nick):
         _odoo_sync_filestore()
         sudo('{0}/cloud-meta odoo-add-version {1}'.format(SERV_DIR_CLOUD_SETUP, branch_nick))
         _odoo_create_initd(branch_nick)
-    else:  # simply restart service after source code checkout
-        _odoo_service_action(branch_nick, 'restart')
+    else:  # restart service after source code checkout, without downtime
+        _odoo_bluegreen_restart(branch_nick)
+
+
+# Update of the sources of odoo series, run on the host with at most $JOBS concurrent jobs. First,
+# each repo fetches all the requested branches into its bare mirror (src/<repo>.git) in a single
+# fetch, then each series is checked out (or updated) in its own worktree (src/<repo>/<branch>),
+# sharing the objects of the mirror. Standalone clones made before the mirrors are updated in place.
+# Each job prints one line: __fetch__ <repo> <branch or *> <ok|error|conflict> <milliseconds>
+_ODOO_FETCH_SCRIPT = r"""
+export SRC={src} DEPTH={depth} FILTER={filter}
+fetch_repo() {{
+    repo=$1; url=$2; shift 2
+    mirror=$SRC/$repo.git; refspecs=''; status=ok; start=$(date +%s%N)
+    for branch in "$@"; do
+        [ -d $SRC/$repo/$branch/.git ] || refspecs="$refspecs +refs/heads/$branch:refs/remotes/origin/$branch"
+    done
+    if [ -n "$refspecs" ]; then
+        if [ ! -d $mirror ]; then
+            git init -q --bare $mirror && git -C $mirror remote add origin $url || status=error
+            if [ -n "$FILTER" ]; then
+                git -C $mirror config remote.origin.promisor true && git -C $mirror config remote.origin.partialclonefilter $FILTER
+            fi
+        fi
+        git -C $mirror fetch --quiet --prune ${{DEPTH:+--depth $DEPTH}} origin $refspecs || status=error
+        git -C $mirror worktree prune
+    fi
+    echo "__fetch__ $repo * $status $(( ($(date +%s%N) - start) / 1000000 ))"
+}}
+checkout_branch() {{
+    repo=$1; branch=$2
+    path=$SRC/$repo/$branch; status=ok; start=$(date +%s%N)
+    mkdir -p $SRC/$repo
+    if [ -d $path/.git ]; then
+        (cd $path && git fetch --quiet --prune && git rebase --quiet --autostash) || status=error
+    elif [ -d $path ]; then
+        # only replay the commits made since the last checkout: with a shallow mirror (DEPTH), the
+        # fetched origin/$branch has no merge-base with the worktree
+        base=$(git -C $path rev-parse --quiet --verify refs/bases/$branch)
+        (cd $path && git rebase --quiet --autostash --onto origin/$branch ${{base:-origin/$branch}}) || status=error
+    else
+        git -C $SRC/$repo.git worktree add -B $branch $path origin/$branch > /dev/null || status=error
+    fi
+    if [ $status = ok ] && [ ! -d $path/.git ]; then
+        git -C $path update-ref refs/bases/$branch origin/$branch
+    fi
+    if [ -d $path ] && ! (cd $path && git diff --diff-filter=U --no-patch --exit-code > /dev/null); then
+        status=conflict
+    fi
+    echo "__fetch__ $repo $branch $status $(( ($(date +%s%N) - start) / 1000000 ))"
+}}
+export -f fetch_repo checkout_branch
+printf '%s\n' {repos} | xargs -P {jobs} -L 1 bash -c 'fetch_repo "$@"' _
+printf '%s\n' {branches} | xargs -P {jobs} -L 1 bash -c 'checkout_branch "$@"' _
+"""
+
+
+def odoo_fetch_sources(branches, jobs=ODOO_FETCH_JOBS):
+    """ Fetch or update the sources of the given odoo series, for all the repos of ODOO_REPO_DIR_MAP,
+        concurrently on the host (see _ODOO_FETCH_SCRIPT)
+        :param branches: list of branch nicknames
+        :param jobs: maximum number of concurrent git commands
+        :rtype list of dict with repo, branch ('*' for the fetch of the mirror), status and duration (ms)
+    """
+    repos = sorted(ODOO_REPO_DIR_MAP.items())
+    script = _ODOO_FETCH_SCRIPT.format(
+        src=ODOO_DIR_SRC,
+        depth=ODOO_GIT_DEPTH or "''",
+        filter=ODOO_GIT_FILTER or "''",
+        jobs=int(jobs),
+        repos=' '.join("'%s %s %s'" % (directory, url, ' '.join(branches)) for directory, url in repos),
+        branches=' '.join("'%s %s'" % (directory, branch) for directory, url in repos for branch in branches),
+    )
+    # run as the odoo user: the created and updated files already have the right owner
+    with hide('running'), settings(warn_only=True):
+        output = sudo(script, user=ODOO_USER)
+    report = []
+    for line in output.splitlines():
+        if line.startswith('__fetch__ '):
+            repo, branch, status, duration = line.split()[1:5]
+            report.append({'repo': repo, 'branch': branch, 'status': status, 'duration': int(duration)})
+
+    report.sort(key=lambda r: (r['repo'], r['branch'] != '*', r['branch']))
+    for r in report:
+        color = green if r['status'] == 'ok' else red
+        puts(color('%-12s %-12s %-9s %8d ms' % (r['repo'], r['branch'], r['status'], r['duration'])))
+    missing = len(repos) * (len(branches) + 1) - len(report)
+    if missing or any(r['status'] != 'ok' for r in report):
+        warn('Sources of %s not (fully) updated%s' % (' '.join(branches), ', %d jobs did not report' % (missing,) if missing else ''))
+    return report
 
 
 def _odoo_fetch_sources(branch_nick):
-    """ Fetch source in src/<version> or update sources """
-    for directory, repo_url in ODOO_REPO_DIR_MAP.items():
-        current_path = ODOO_DIR_SRC + '/' + directory + '/'
-        if fabtools.files.is_dir(current_path + branch_nick):
-            git_update_directory(current_path + branch_nick)
-        else:
-            sudo('mkdir -p {0}'.format(current_path))
-            result = git_clone(current_path, repo_url, branch_nick, branch_nick)
-            if result:
-                puts(blue('Odoo %s sources fetched !' % (branch_nick,)))
-            else:
-                puts(red('Error when fetching Odoo %s sources !' % (branch_nick,)))
-        run("chown -R {0}:{0} {1}".format(ODOO_USER, current_path))
+    """ Fetch source in src/<repo>/<version> or update sources. Abort if a repo is not (fully)
+        updated: the service must not be created or restarted on a missing or conflicting tree.
+    """
+    report = odoo_fetch_sources([branch_nick])
+    failed = ['%s %s: %s' % (r['repo'], r['branch'], r['status']) for r in report if r['status'] != 'ok']
+    missing = len(ODOO_REPO_DIR_MAP) * 2 - len(report)  # one fetch and one checkout per repo
+    if missing:
+        failed.append('%d jobs did not report' % (missing,))
+    if failed:
+        abort('Sources of %s not updated: %s' % (branch_nick, ', '.join(failed)))
+    return report
+
+
+@task
+@as_('root')
+def odoo_fetch(branches=None, jobs=ODOO_FETCH_JOBS):
+    """ Odoo: fetch or update the sources of the given series (space separated), or of all the
+        series of the meta database, in parallel on the host.
+
+            fab -H root@1.1.1.1 odoo_fetch:branches="11.0 saas-11.3",jobs=8
+    """
+    if branches:
+        branches = branches.split()
+    else:
+        with hide('output', 'running'):
+            branches = sudo('{0}/cloud-meta odoo-list-branches'.format(SERV_DIR_CLOUD_SETUP)).split()
+    odoo_fetch_sources(branches, jobs=jobs)
 
 
 def _odoo_sync_filestore():
-    # create a filestore directory and symlink from ~/.local to /home/odoo : one filestore per database
-    sudo('mkdir -p {0}/filestore'.format(ODOO_DIR_HOME))
-    # resymlink
     product = 'Odoo'  # hardcoded (was 'OpenERP' in 8.0)
-    sudo('mkdir -p {0}/.local/share/{1}/sessions'.format(ODOO_DIR_HOME, product))
-    sudo('ln -sfT {0}/filestore {0}/.local/share/{1}/filestore'.format(ODOO_DIR_HOME, product))
+    with remote_batch() as batch:
+        # create a filestore directory and symlink from ~/.local to /home/odoo : one filestore per database
+        batch.sudo('mkdir -p {0}/filestore'.format(ODOO_DIR_HOME))
+        # resymlink
+        batch.sudo('mkdir -p {0}/.local/share/{1}/sessions'.format(ODOO_DIR_HOME, product))
+        batch.sudo('ln -sfT {0}/filestore {0}/.local/share/{1}/filestore'.format(ODOO_DIR_HOME, product))
 
 
-def _odoo_branch2service(branch):
+def _odoo_branch2service(branch, instance=0):
     """returns a tuple (service_name, service_path)"""
     service_name = 'openerp-' + branch
+    if instance:
+        service_name += '-%s' % (instance,)
     if has_systemd():
         service_path = '/etc/systemd/system/{0}.service'.format(service_name)
     else:
@@ -547,10 +1327,23 @@ def _odoo_branch2service(branch):
 
 
 @as_('root')
-def _odoo_create_initd(branch):
-    """ create the initd file for the service """
+@mutates_host
+def _odoo_create_initd(branch, instance=0, ports=None, enable=True):
+    """ create the initd file for the service
+        :param instance: instance of the series, the other ones than 0 require systemd
+        :param ports: tuple (port, longpolling_port) of the instance, by default the launcher asks the
+            ones of the series to cloud-meta
+        :param enable: start the service at boot
+    """
+    service_name, service_path = _odoo_branch2service(branch, instance)
+    environment = ['OE_PORT=%s LONGPOLLPORT=%s' % ports] if ports else []
+    if instance:
+        # both instances run during the drain of a blue/green restart: each one has its own log
+        environment.append('OE_LOGFILE={0}/log/{1}.log'.format(ODOO_DIR_HOME, service_name))
     ctx = {
-        'branch': branch
+        'branch': branch,
+        'service': service_name,
+        'environment': ' '.join(environment),
     }
 
     sudo('ln -sf {0}/bin/openerp {0}/bin/openerp-{1}'.format(ODOO_DIR_HOME, branch))
@@ -558,12 +1351,12 @@ def _odoo_create_initd(branch):
     def _upload_template(template, target, mode):
         upload_template(os.path.join(LOCAL_DIR_RESOURCES, template), target, ctx, backup=False, mode=mode)
 
-    service_name, service_path = _odoo_branch2service(branch)
     if has_systemd():
         # systemd
         _upload_template('unit_openerp.tpl', service_path, '0644')
         run('systemctl daemon-reload')
-        fabtools.systemd.enable(service_name)
+        if enable:
+            fabtools.systemd.enable(service_name)
     else:
         # SysV init
         _upload_template('initd_openerp.tpl', service_path, '0755')
@@ -571,17 +1364,19 @@ def _odoo_create_initd(branch):
 
 
 def _odoo_is_service_running(branch_nick):
-    """ check if the service of given branch exists and is running """
-    service_name, service_path = _odoo_branch2service(branch_nick)
-    if fabtools.files.is_file(service_path):
-        return fabtools.systemd.is_running(service_name)
+    """ check if a service of given branch exists and is running """
+    for instance in ODOO_BLUEGREEN_INSTANCES:
+        service_name, service_path = _odoo_branch2service(branch_nick, instance)
+        if service_path in host_facts()['service_files'] and service_is_running(service_name):
+            return True
     return False
 
 
+@mutates_host
 def _odoo_service_action(branch_nick, action):
     service_name, service_path = _odoo_branch2service(branch_nick)
 
-    if not fabtools.files.is_file(service_path):
+    if service_path not in host_facts()['service_files']:
         puts(yellow('service {0} missing: skipping'.format(branch_nick)))
     else:
         if has_systemd():
@@ -590,6 +1385,117 @@ def _odoo_service_action(branch_nick, action):
             run('{0} {1}'.format(service_path, action))
 
 
+def _odoo_instance_ports(branch):
+    """ :returns dict {instance: (port, longpolling_port)} of the instances of the series """
+    with hide('output', 'running'):
+        rows = json.loads(sudo('{0}/cloud-meta odoo-list-ports {1} --format=json --fresh'.format(SERV_DIR_CLOUD_SETUP, branch)))
+    ports = {}
+    for row in rows:
+        ports.setdefault(row['instance'], {})[row['purpose']] = row['port']
+    return dict((instance, (p.get('http'), p.get('longpolling'))) for instance, p in ports.items())
+
+
+# Health check of a new odoo instance listening on {port}: wait until it answers a json-rpc call,
+# then load the registry of each database by requesting its login page with its host name (the
+# instance is in proxy mode, its db filter uses the forwarded host). Prints `__health__ <ok|timeout>`,
+# then `__warm__ <host> <http code>` per host.
+_ODOO_HEALTH_SCRIPT = r"""
+deadline=$(( $(date +%s) + {timeout} ))
+until curl -sf -o /dev/null -m 10 -H 'Content-Type: application/json' -d '{{"jsonrpc": "2.0", "method": "call", "params": {{}}}}' http://127.0.0.1:{port}/web/webclient/version_info; do
+    if [ $(date +%s) -ge $deadline ]; then echo '__health__ timeout'; exit 1; fi
+    sleep 1
+done
+echo '__health__ ok'
+for host in {domains}; do
+    echo "__warm__ $host $(curl -s -o /dev/null -m {timeout} -w '%{{http_code}}' -H "Host: $host" -H "X-Forwarded-Host: $host" http://127.0.0.1:{port}/web/login)"
+done
+"""
+
+
+def _odoo_health_check(branch, port):
+    """ Wait for the instance of the series listening on `port` to answer, and warm up the
+        registries of the databases of the series
+        :returns True if the instance answered, failing databases are only reported
+    """
+    with hide('output', 'running'):
+        accounts = json.loads(sudo('{0}/cloud-meta list-accounts --format=json'.format(SERV_DIR_CLOUD_SETUP)))
+    domains = [a['name'] for a in accounts if a['service_type'] == 'odoo' and a['version'] == branch and a['databases']]
+    script = _ODOO_HEALTH_SCRIPT.format(port=int(port), timeout=ODOO_HEALTH_TIMEOUT, domains=' '.join(domains))
+    with hide('output', 'running'), settings(warn_only=True):
+        output = sudo(script)
+    healthy = False
+    for line in output.splitlines():
+        if line.startswith('__health__ '):
+            healthy = line.split()[1] == 'ok'
+        elif line.startswith('__warm__ '):
+            host, code = (line.split() + [''])[1:3]
+            if code[:1] in ('2', '3'):
+                puts(green('{0}: ready ({1})'.format(host, code)))
+            else:
+                warn('{0}: not loaded by the new instance ({1})'.format(host, code or 'no answer'))
+    return healthy
+
+
+def _nginx_legacy_sites():
+    """ :returns the enabled nginx sites declaring their own `odoo` and `odoochat` upstreams """
+    with hide('output', 'running'), settings(warn_only=True):
+        output = sudo("grep -RlsE '^upstream odoo(chat)? [{]' /etc/nginx/sites-enabled/")
+    return output.split()
+
+
+@mutates_host
+def _odoo_bluegreen_restart(branch):
+    """ Restart the service of the series without downtime: the idle instance (blue/green) is
+        (re)started on its own ports with the new code and warmed up, then nginx sends the requests
+        to it (graceful reload), and the previously active instance is stopped once drained.
+        Without systemd, the service is simply restarted.
+    """
+    if not has_systemd():
+        return _odoo_service_action(branch, 'restart')
+    cloud_meta = SERV_DIR_CLOUD_SETUP + '/cloud-meta'
+
+    ports = _odoo_instance_ports(branch)
+    # reserve the missing ports by instance number: odoo-add-instance reserves the instance after
+    # the highest one, and would never fill a gap in the instances of the series
+    missing = [(instance, purpose) for instance in ODOO_BLUEGREEN_INSTANCES
+               for purpose, port in zip(('http', 'longpolling'), ports.get(instance, (None, None))) if not port]
+    for instance, purpose in missing:
+        sudo('{0} odoo-reserve-port {1} {2} --instance={3}'.format(cloud_meta, branch, purpose, instance))
+    if missing:
+        ports = _odoo_instance_ports(branch)
+
+    # the sites written by the former template declare their own upstreams, that a switch does not
+    # move: they are first regenerated, on the upstreams of the active instance
+    if _nginx_legacy_sites():
+        nginx_sync()
+        legacy = _nginx_legacy_sites()
+        if legacy:
+            abort('{0} still declare their own upstreams, {1} can not be switched'.format(' '.join(legacy), branch))
+
+    with hide('output', 'running'):
+        active = int(sudo('{0} odoo-active-instance {1}'.format(cloud_meta, branch)))
+    target = next(instance for instance in ODOO_BLUEGREEN_INSTANCES if instance != active)
+    old_service, old_service_path = _odoo_branch2service(branch, active)
+    service, service_path = _odoo_branch2service(branch, target)
+
+    # the unit of an extra instance holds its ports and log file: it is rewritten to follow them
+    if target or service_path not in host_facts()['service_files']:
+        _odoo_create_initd(branch, target, ports[target] if target else None, enable=False)
+    fabtools.systemd.restart(service)
+    if not _odoo_health_check(branch, ports[target][0]):
+        fabtools.systemd.stop(service)
+        abort('{0} did not answer within {1}s, {2} keeps serving {3}'.format(service, ODOO_HEALTH_TIMEOUT, old_service, branch))
+
+    sudo('{0} odoo-switch-instance {1} {2}'.format(cloud_meta, branch, target))
+    # the active instance is the one started at boot
+    fabtools.systemd.enable(service)
+    if old_service_path in host_facts()['service_files']:
+        fabtools.systemd.disable(old_service)
+        puts('{0} now serves {1}, draining {2} for {3}s'.format(service, branch, old_service, ODOO_DRAIN_DELAY))
+        time.sleep(ODOO_DRAIN_DELAY)
+        fabtools.systemd.stop(old_service)
+
+
 @task
 def odoo_db_add(domain, branch_nick, dbname=False):
     if not _validate_domain(domain):
@@ -605,20 +1511,53 @@ def odoo_db_add(domain, branch_nick, dbname=False):
     odoo_create_nginx_config(dbname)
 
 
+@task
+def odoo_db_add_many(domains, branch_nick):
+    """ Odoo: add the databases of several domains (space separated) to a series, then regenerate
+        the nginx sites with a single reload
+
+            fab -H root@1.1.1.1 odoo_db_add_many:domains="a.example.com b.example.com",branch_nick=11.0
+    """
+    domains = domains.split()
+    for domain in domains:
+        if not _validate_domain(domain):
+            raise Exception("Given domain is not correct. Got '%s'." % (domain,))
+
+    # insert meta entries
+    with remote_batch() as batch:
+        for domain in domains:
+            batch.sudo('{0}/cloud-meta odoo-add-database {1} {2} {3}'.format(SERV_DIR_CLOUD_SETUP, domain, branch_nick, domain2database(domain)))
+
+    nginx_sync()
+
+
+@task
+@as_('root')
+def nginx_sync(jobs=4):
+    """ Nginx: regenerate the upstreams and the sites of all the odoo databases from the meta
+        database, in one pass on the host. Unchanged files are left untouched, and nginx is checked
+        then reloaded once if a file changed.
+    """
+    with settings(warn_only=True):
+        result = sudo('{0}/cloud-meta batch-nginx --jobs={1}'.format(SERV_DIR_CLOUD_SETUP, int(jobs)))
+    if result.failed:
+        abort('nginx sites not synchronized: {0}'.format(result))
+
+
 @task
 def odoo_create_nginx_config(dbname):
-    """ Create the nginx config file and restart nginx service
+    """ Create the nginx config file and reload nginx service
         :param dbname: name of the database to (re)generate the config file
     """
     dbinfo_str = sudo('{0}/cloud-meta odoo-get-info {1}'.format(SERV_DIR_CLOUD_SETUP, dbname))
     dbinfo = json.loads(dbinfo_str)
+    dbinfo['url'] = dbinfo['service_name']
+
+    # (re)write the upstreams of the series, used by the site
+    sudo('{0}/cloud-meta odoo-switch-instance {1}'.format(SERV_DIR_CLOUD_SETUP, dbinfo['version']))
 
     # create nginx file
     upload_template(os.path.join(LOCAL_DIR_RESOURCES, 'nginx_openerp.tpl'), '/etc/nginx/sites-availables/%s' % (dbname,), dbinfo, backup=False, mode='0644')
     run("ln -sfT /etc/nginx/sites-availables/%s /etc/nginx/sites-enabled/%s" % (dbname, dbname))
 
-    # restart nginx
-    if fabtools.systemd.is_running('nginx'):
-        fabtools.systemd.restart('nginx')
-    else:
-        fabtools.systemd.start('nginx')
+    nginx_reload()
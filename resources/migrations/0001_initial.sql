@@ -1,3 +1,4 @@
+-- types and tables of the meta database
 
 DO $$ BEGIN
     CREATE TYPE db_type_type AS ENUM ('mysql', 'postgres');
@@ -43,10 +44,3 @@ CREATE TABLE IF NOT EXISTS database(
     db_type db_type_type NOT NULL DEFAULT 'mysql',
     service_id integer NOT NULL REFERENCES service_account(id) ON DELETE CASCADE
 );
-
-
-DROP INDEX IF EXISTS databases_name_per_type_uniq;
-CREATE UNIQUE INDEX databases_name_per_type_uniq ON database(name, db_type);
-
-ALTER TABLE service_account DROP CONSTRAINT IF EXISTS version_required_for_odoo;
-ALTER TABLE service_account ADD CONSTRAINT version_required_for_odoo CHECK((service_type='odoo' AND odoo_version_id IS NOT NULL) or (service_type!='odoo'));
@@ -0,0 +1,3 @@
+-- migration: no-transaction
+-- built concurrently, without locking the lookups on the database table
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS databases_name_per_type_uniq ON database(name, db_type);
@@ -0,0 +1,7 @@
+-- the constraint is added without checking the existing rows (NOT VALID), so the exclusive lock
+-- on service_account is held only for a moment. Rows are checked by the next migration.
+DO $$ BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'version_required_for_odoo') THEN
+        ALTER TABLE service_account ADD CONSTRAINT version_required_for_odoo CHECK((service_type='odoo' AND odoo_version_id IS NOT NULL) or (service_type!='odoo')) NOT VALID;
+    END IF;
+END $$;
@@ -0,0 +1,2 @@
+-- validating only takes a SHARE UPDATE EXCLUSIVE lock: reads and writes are not blocked
+ALTER TABLE service_account VALIDATE CONSTRAINT version_required_for_odoo;
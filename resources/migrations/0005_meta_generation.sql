@@ -0,0 +1,29 @@
+-- generation counter, bumped on every change, used to keep local snapshots in sync
+CREATE TABLE IF NOT EXISTS meta_generation(
+    id integer PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    generation bigint NOT NULL DEFAULT 0,
+    update_date timestamp without time zone DEFAULT NOW()
+);
+INSERT INTO meta_generation (id) VALUES (1) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION meta_bump_generation() RETURNS trigger AS $$
+BEGIN
+    UPDATE meta_generation SET generation = generation + 1, update_date = NOW() WHERE id = 1;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION meta_set_update_date() RETURNS trigger AS $$
+BEGIN
+    NEW.update_date = NOW();
+    RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS service_account_update_date ON service_account;
+CREATE TRIGGER service_account_update_date BEFORE UPDATE ON service_account FOR EACH ROW EXECUTE PROCEDURE meta_set_update_date();
+
+DROP TRIGGER IF EXISTS odoo_version_generation ON odoo_version;
+CREATE TRIGGER odoo_version_generation AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON odoo_version FOR EACH STATEMENT EXECUTE PROCEDURE meta_bump_generation();
+DROP TRIGGER IF EXISTS service_account_generation ON service_account;
+CREATE TRIGGER service_account_generation AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON service_account FOR EACH STATEMENT EXECUTE PROCEDURE meta_bump_generation();
+DROP TRIGGER IF EXISTS database_generation ON database;
+CREATE TRIGGER database_generation AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON database FOR EACH STATEMENT EXECUTE PROCEDURE meta_bump_generation();
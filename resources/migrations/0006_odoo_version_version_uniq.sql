@@ -0,0 +1,3 @@
+-- migration: no-transaction
+-- one row per version: ports and lookups are resolved by version name
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS odoo_version_version_uniq ON odoo_version(version);
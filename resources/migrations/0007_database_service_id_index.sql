@@ -0,0 +1,3 @@
+-- migration: no-transaction
+-- join of the databases of an account, and ON DELETE CASCADE from service_account
+CREATE INDEX CONCURRENTLY IF NOT EXISTS database_service_id_index ON database(service_id);
@@ -0,0 +1,3 @@
+-- migration: no-transaction
+-- ON DELETE CASCADE from odoo_version, and accounts of a version
+CREATE INDEX CONCURRENTLY IF NOT EXISTS service_account_odoo_version_id_index ON service_account(odoo_version_id);
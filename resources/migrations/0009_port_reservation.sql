@@ -0,0 +1,41 @@
+-- ports reserved by the odoo instances: one row per port, so two instances can never share a port.
+-- Instance 0 is the main instance of the version, its ports are also kept on odoo_version.
+CREATE TABLE IF NOT EXISTS port_reservation(
+    port integer PRIMARY KEY,
+    odoo_version_id integer NOT NULL REFERENCES odoo_version(id) ON DELETE CASCADE,
+    instance integer NOT NULL DEFAULT 0,
+    purpose varchar NOT NULL,
+    create_date timestamp without time zone DEFAULT NOW(),
+    UNIQUE (odoo_version_id, instance, purpose)
+);
+
+-- the ports of the existing versions are reserved: versions sharing a port must be fixed first,
+-- one of them would be left without reservation while its launcher still uses the shared port
+DO $$
+DECLARE
+    collisions text;
+BEGIN
+    SELECT string_agg(port || ' (' || versions || ')', ', ') INTO collisions
+    FROM (
+        SELECT port, string_agg(version || ' ' || purpose, ', ' ORDER BY version) AS versions
+        FROM (
+            SELECT port, version, 'http' AS purpose FROM odoo_version WHERE port IS NOT NULL
+            UNION ALL
+            SELECT longpolling_port, version, 'longpolling' FROM odoo_version WHERE longpolling_port IS NOT NULL
+        ) ports
+        GROUP BY port
+        HAVING count(*) > 1
+    ) shared;
+    IF collisions IS NOT NULL THEN
+        RAISE EXCEPTION 'odoo versions sharing a port, change their ports before migrating: %', collisions;
+    END IF;
+END
+$$;
+
+INSERT INTO port_reservation (port, odoo_version_id, instance, purpose)
+SELECT port, id, 0, 'http' FROM odoo_version WHERE port IS NOT NULL;
+INSERT INTO port_reservation (port, odoo_version_id, instance, purpose)
+SELECT longpolling_port, id, 0, 'longpolling' FROM odoo_version WHERE longpolling_port IS NOT NULL;
+
+DROP TRIGGER IF EXISTS port_reservation_generation ON port_reservation;
+CREATE TRIGGER port_reservation_generation AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON port_reservation FOR EACH STATEMENT EXECUTE PROCEDURE meta_bump_generation();
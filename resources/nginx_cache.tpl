@@ -0,0 +1,6 @@
+# proxy cache of the odoo static files, asset bundles and images, shared by all the sites of the
+# host and sized from its resources (written by fab deploy)
+proxy_cache_path %(cache_dir)s levels=1:2 keys_zone=odoo:%(keys_mb)sm max_size=%(max_size_mb)sm inactive=7d use_temp_path=off;
+
+# cache status of the cached locations, see fab nginx_cache_stats
+log_format odoo_cache '$host $upstream_cache_status $request_uri';
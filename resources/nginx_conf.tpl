@@ -1,12 +1,15 @@
+# rendered from the host facts by fab deploy
 user  www-data;
-worker_processes  1;
+worker_processes  %(worker_processes)s;
+worker_rlimit_nofile  %(worker_rlimit_nofile)s;
 
 error_log  /var/log/nginx/error.log warn;
 pid        /var/run/nginx.pid;
 
 
 events {
-    worker_connections  1024;
+    worker_connections  %(worker_connections)s;
+    multi_accept  on;
 }
 
 
@@ -21,7 +24,14 @@ http {
     access_log  /var/log/nginx/access.log  main;
 
     sendfile        on;
-    #tcp_nopush     on;
+    tcp_nopush      on;
+    tcp_nodelay     on;
+
+    # descriptors and metadata of the files served directly (static files of the lemp sites)
+    open_file_cache           max=%(open_file_cache)s inactive=60s;
+    open_file_cache_valid     120s;
+    open_file_cache_min_uses  2;
+    open_file_cache_errors    on;
 
     keepalive_timeout  65;
 
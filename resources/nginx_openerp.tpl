@@ -1,11 +1,6 @@
 # odoo server config for %(url)s
-upstream odoo {
-        server 127.0.0.1:%(port)s;
-}
-upstream odoochat {
-        server 127.0.0.1:%(longpollingport)s;
-}
-
+# the upstreams odoo-%(version)s and odoochat-%(version)s are shared by the sites of the version,
+# see nginx_upstream_openerp.tpl
 
 server {
         listen 80;
@@ -20,15 +15,67 @@ server {
         proxy_set_header X-Forwarded-Proto $scheme;
         proxy_set_header X-Real-IP $remote_addr;
 
+        # keep the connections to the upstreams alive
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+
         # Redirect longpoll requests to odoo longpolling port
         location /longpolling {
-                proxy_pass http://odoochat;
+                proxy_pass http://odoochat-%(version)s;
+                # a poll is held up to 50s, notifications are sent as soon as they are received
+                proxy_buffering off;
+                proxy_read_timeout 75s;
+                proxy_send_timeout 75s;
+                proxy_connect_timeout 5s;
+        }
+
+        # Static files and asset bundles (their url changes with their content) are cached for all
+        # the visitors of the site (the proxy cache is defined in conf.d/odoo-cache.conf). Only one
+        # request per file reaches odoo, the others wait for it or are served the stale copy.
+        # Odoo sets the session cookie on every response of its dispatcher, and nginx does not cache
+        # the responses setting a cookie: the cookie is ignored, and never sent from the cache.
+        location ~ ^/[^/]+/static/|^/web/content/[^/]+/[^/]*assets {
+                proxy_redirect off;
+                proxy_pass http://odoo-%(version)s;
+                proxy_cache odoo;
+                proxy_cache_key $scheme$host$request_uri;
+                proxy_ignore_headers Set-Cookie;
+                proxy_hide_header Set-Cookie;
+                proxy_cache_valid 200 60m;
+                proxy_cache_lock on;
+                proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;
+                add_header X-Cache-Status $upstream_cache_status;
+                access_log /var/log/nginx/access.log main;
+                access_log /var/log/nginx/odoo-cache.log odoo_cache;
+        }
+
+        # Images are cached per session: the ones of the records are only visible to some users.
+        # Odoo only lets cache the images requested with their checksum. As for the assets, the
+        # session cookie it sets is ignored: a cached copy must not hand a session to the visitors
+        # without one (they share the same key).
+        location /web/image {
+                proxy_redirect off;
+                proxy_pass http://odoo-%(version)s;
+                proxy_cache odoo;
+                proxy_cache_key $scheme$host$request_uri$cookie_session_id;
+                proxy_ignore_headers Set-Cookie;
+                proxy_hide_header Set-Cookie;
+                proxy_cache_lock on;
+                proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;
+                add_header X-Cache-Status $upstream_cache_status;
+                access_log /var/log/nginx/access.log main;
+                access_log /var/log/nginx/odoo-cache.log odoo_cache;
         }
 
         # Redirect requests to odoo backend server
         location / {
           proxy_redirect off;
-          proxy_pass http://odoo;
+          proxy_pass http://odoo-%(version)s;
+          # buffer the responses in memory (asset bundles, reports), so the odoo worker is freed
+          # before the response reaches slow clients
+          proxy_buffer_size 128k;
+          proxy_buffers 16 64k;
+          proxy_busy_buffers_size 256k;
         }
 
         # common gzip
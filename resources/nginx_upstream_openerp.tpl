@@ -0,0 +1,11 @@
+# odoo %(version)s upstreams, instance %(instance)s (written by cloud-meta odoo-switch-instance)
+# idle connections kept open to the instance by each nginx worker, instead of one new connection
+# per request (the sites use HTTP/1.1 and clear the Connection header)
+upstream odoo-%(version)s {
+        server 127.0.0.1:%(port)s;
+        keepalive 16;
+}
+upstream odoochat-%(version)s {
+        server 127.0.0.1:%(longpolling_port)s;
+        keepalive 32;
+}
@@ -1,13 +1,14 @@
 [Unit]
-Description=openerp/odoo %(branch)s
+Description=openerp/odoo %(branch)s (%(service)s)
 
 [Service]
 Type=simple
 User=odoo
+Environment=%(environment)s
 LimitNOFILE=16384
 ExecStart=/home/odoo/bin/openerp-%(branch)s
-ExecStartPost=/bin/sh -c "/bin/echo $MAINPID > /home/odoo/log/openerp-%(branch)s.pid"
-ExecStopPost=/bin/sh -c "/bin/rm /home/odoo/log/openerp-%(branch)s.pid"
+ExecStartPost=/bin/sh -c "/bin/echo $MAINPID > /home/odoo/log/%(service)s.pid"
+ExecStopPost=/bin/sh -c "/bin/rm /home/odoo/log/%(service)s.pid"
 TimeoutStopSec=5
 KillMode=mixed
 Restart=on-failure
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+    Benchmark of the cloud-meta lookups on a local PostgreSQL.
+
+    For each size, a `meta_bench` database is (re)created and filled with synthetic tenants (half
+    odoo with one postgres database each, half lemp with one mysql database each). Every cloud_meta
+    function is timed twice: with the schema without the lookup indexes (all migrations but
+    INDEX_MIGRATIONS), then with all the migrations applied. Timings are in milliseconds.
+
+    Usage:
+        meta_benchmark.py [--sizes=<sizes>] [--repeat=<n>] [--versions=<n>] [--keep]
+
+    Options:
+        --sizes=<sizes>     Comma separated numbers of tenants [default: 10000,100000,1000000]
+        --repeat=<n>        Number of calls of each lookup [default: 200]
+        --versions=<n>      Number of odoo versions [default: 20]
+        --keep              Do not drop the benchmark database at the end
+"""
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import cloud_meta
+
+BENCH_DB = 'meta_bench'
+INDEX_MIGRATIONS = ['0006_odoo_version_version_uniq', '0007_database_service_id_index', '0008_service_account_odoo_version_id_index']
+
+_POPULATE_QUERIES = [
+    """
+        INSERT INTO odoo_version (version, port, longpolling_port)
+        SELECT v || '.0', 8069 + 100 * v, 8072 + 100 * v
+        FROM generate_series(1, %(versions)s) v
+    """,
+    """
+        INSERT INTO service_account (name, server_name, unix_user, unix_group, service_type, odoo_version_id)
+        SELECT
+            'tenant' || i || '.example.com',
+            'tenant' || i || 'examplecom',
+            CASE WHEN i %% 2 = 0 THEN 'odoo' ELSE 'user' || i END,
+            CASE WHEN i %% 2 = 0 THEN 'odoo' ELSE 'user' || i END,
+            CASE WHEN i %% 2 = 0 THEN 'odoo' ELSE 'lemp' END::service_type_type,
+            CASE WHEN i %% 2 = 0 THEN 1 + i %% %(versions)s END
+        FROM generate_series(1, %(size)s) i
+    """,
+    """
+        INSERT INTO database (name, db_type, service_id)
+        SELECT server_name, CASE WHEN service_type = 'odoo' THEN 'postgres' ELSE 'mysql' END::db_type_type, id
+        FROM service_account
+    """,
+]
+
+
+def _admin_execute(query):
+    import psycopg2
+    cnx = psycopg2.connect('dbname=postgres')
+    cnx.autocommit = True
+    try:
+        cnx.cursor().execute(query)
+    finally:
+        cnx.close()
+
+
+def _reset_pool():
+    """ drop the connections of the previous benchmark database """
+    for pool in cloud_meta._METAPOOL.values():
+        pool.closeall()
+    cloud_meta._METAPOOL.clear()
+
+
+def _analyze():
+    with cloud_meta.cursor() as cr:
+        cr.connection.autocommit = True
+        try:
+            cr.execute("ANALYZE")
+        finally:
+            cr.connection.autocommit = False
+
+
+class Context(object):
+
+    def __init__(self, size, versions):
+        self.size = size
+        self.versions = versions
+        self.counter = 0
+        self.created = []  # accounts created by the benchmark, to delete
+
+    def new_domain(self, prefix):
+        self.counter += 1
+        domain = '%s%d.example.com' % (prefix, self.counter)
+        self.created.append(domain)
+        return domain
+
+    def tenant(self, odoo=True):
+        """ index of a random existing tenant, even for odoo and odd for lemp """
+        index = random.randint(1, self.size // 2) * 2
+        return index if odoo else index - 1
+
+    def version(self):
+        return '%d.0' % (random.randint(1, self.versions),)
+
+    def unique(self):
+        self.counter += 1
+        return self.counter
+
+
+def _delete_account(name):
+    with cloud_meta.cursor() as cr:
+        cr.execute("DELETE FROM service_account WHERE name = %s", (name,))
+
+
+# (name, number of calls: None for --repeat, function of the context)
+BENCHMARKS = [
+    ('odoo_get_port', None, lambda ctx: cloud_meta.odoo_get_port(ctx.version())),
+    ('odoo_get_longpolling_port', None, lambda ctx: cloud_meta.odoo_get_longpolling_port(ctx.version())),
+    ('odoo_list_branches', None, lambda ctx: cloud_meta.odoo_list_branches()),
+    ('odoo_list_branches_info', None, lambda ctx: cloud_meta.odoo_list_branches_info()),
+    ('odoo_last_branch', None, lambda ctx: cloud_meta.odoo_last_branch()),
+    ('odoo_get_info', None, lambda ctx: cloud_meta.odoo_get_info('tenant%dexamplecom' % (ctx.tenant(),))),
+    ('account_get_service_type', None, lambda ctx: cloud_meta.account_get_service_type('tenant%d.example.com' % (ctx.tenant(),))),
+    ('account_info', None, lambda ctx: cloud_meta.account_info('tenant%d.example.com' % (ctx.tenant(odoo=False),))),
+    ('lemp_info', None, lambda ctx: cloud_meta.lemp_info('tenant%d.example.com' % (ctx.tenant(odoo=False),))),
+    ('odoo_add_version', None, lambda ctx: cloud_meta.odoo_add_version('saas-%d.%d' % (100 + ctx.unique(), 1))),
+    ('odoo_add_database', None, lambda ctx: cloud_meta.odoo_add_database(ctx.new_domain('new'), ctx.version())),
+    ('lemp_add', None, lambda ctx: cloud_meta.lemp_add(ctx.new_domain('lemp'), 'user', 'user')),
+    ('delete account (cascade)', None, lambda ctx: _delete_account(ctx.created.pop())),
+    ('account_list', 1, lambda ctx: cloud_meta.account_list()),
+    ('meta_export', 1, lambda ctx: cloud_meta.meta_export(open(os.devnull, 'w'))),
+    ('snapshot_refresh', 1, lambda ctx: cloud_meta.snapshot_refresh(path='/tmp/meta_bench_snapshot.db', force=True)),
+]
+
+
+def _run_benchmarks(ctx, repeat):
+    """ :returns dict {name: (median, p95)} in milliseconds """
+    result = {}
+    for name, count, func in BENCHMARKS:
+        timings = []
+        for dummy in range(count or repeat):
+            start = time.time()
+            func(ctx)
+            timings.append((time.time() - start) * 1000)
+        timings.sort()
+        result[name] = (timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.95))])
+    return result
+
+
+def bench(size, repeat, versions):
+    _reset_pool()
+    _admin_execute('DROP DATABASE IF EXISTS %s' % (BENCH_DB,))
+    _admin_execute('CREATE DATABASE %s' % (BENCH_DB,))
+
+    cloud_meta.meta_migrate(exclude=INDEX_MIGRATIONS)
+    start = time.time()
+    with cloud_meta.cursor() as cr:
+        for query in _POPULATE_QUERIES:
+            cr.execute(query, {'size': size, 'versions': versions})
+    sys.stderr.write('%d tenants created in %.1fs\n' % (size, time.time() - start))
+    _analyze()
+
+    # same random tenants before and after
+    random.seed(size)
+    before = _run_benchmarks(Context(size, versions), repeat)
+
+    applied = cloud_meta.meta_migrate()
+    sys.stderr.write('indexes migrations applied: %s\n' % (', '.join(applied),))
+    _analyze()
+    random.seed(size)
+    ctx = Context(size, versions)
+    ctx.counter = 10 * repeat  # do not insert the same new entries as before
+    after = _run_benchmarks(ctx, repeat)
+    return before, after
+
+
+def main():
+    from docopt import docopt
+    opt = docopt(__doc__)
+    cloud_meta.META = BENCH_DB
+
+    print('%-28s %10s %14s %14s %14s %14s' % ('function', 'tenants', 'before median', 'before p95', 'after median', 'after p95'))
+    try:
+        for size in [int(s) for s in opt['--sizes'].split(',')]:
+            before, after = bench(size, int(opt['--repeat']), int(opt['--versions']))
+            for name, count, func in BENCHMARKS:
+                print('%-28s %10d %14.3f %14.3f %14.3f %14.3f' % ((name, size) + before[name] + after[name]))
+            sys.stdout.flush()
+    finally:
+        _reset_pool()
+        if not opt['--keep']:
+            _admin_execute('DROP DATABASE IF EXISTS %s' % (BENCH_DB,))
+
+if __name__ == '__main__':
+    main()